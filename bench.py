@@ -0,0 +1,417 @@
+import os, sys, time, zlib, json, tempfile, shutil
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+from pdf import PDF, PDFObject
+from pdf_utils import *
+from optparse import OptionParser
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#    Benchmarks for the PDF class, run against synthetic
+#    files so that results can be repeated on any machine,
+#    and the bundled stream_test.pdf:
+#
+#        python bench.py [-p pages] [-n objects] [file ...]
+#            > results.json
+#        python bench.py -b results.json
+#
+#    Each case runs in a process of its own so that its peak
+#    memory can be measured, results are written as JSON and
+#    compared against a baseline from an earlier run
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def make_pdf(filename,pages=100,fanout=8,stream_size=400,compress=True,objects=0):
+    '''write a file of <pages> pages, each with its own content stream, under a
+    balanced page tree with <fanout> kids to a node.  Content streams are Flate
+    encoded when <compress> is set.  <objects> more small dictionaries are
+    listed in an array from the catalog'''
+    objs = {}
+    def new_obj_id():
+        return len(objs) + 1
+    catalog = new_obj_id()
+    objs[catalog] = None
+    info = new_obj_id()
+    objs[info] = "<< /Title (Benchmark) /Producer (PyDF bench) >>"
+    font = new_obj_id()
+    objs[font] = "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    def add_pages(parent,count):
+        kids = []
+        if count <= fanout:
+            for i in range(count):
+                page = new_obj_id()
+                objs[page] = None
+                contents = new_obj_id()
+                text = "BT /F1 12 Tf 72 720 Td (Page " + str(page) + ") Tj ET\n" + "% filler\n"*(stream_size/9)
+                if compress:
+                    data = zlib.compress(text)
+                    objs[contents] = "<< /Length " + str(len(data)) + " /Filter /FlateDecode >>\nstream\n" + data + "\nendstream"
+                else:
+                    objs[contents] = "<< /Length " + str(len(text)) + " >>\nstream\n" + text + "\nendstream"
+                objs[page] = "<< /Type /Page /Parent " + str(parent) + " 0 R /MediaBox [ 0 0 612 792 ] /Resources << /Font << /F1 " + str(font) + " 0 R >> >> /Contents " + str(contents) + " 0 R >>"
+                kids.append(page)
+            return kids
+        step = (count + fanout - 1)/fanout
+        while count > 0:
+            node = new_obj_id()
+            objs[node] = None
+            sub = add_pages(node,min(step,count))
+            objs[node] = "<< /Type /Pages /Parent " + str(parent) + " 0 R /Kids [ " + " ".join(str(i) + " 0 R" for i in sub) + " ] /Count " + str(min(step,count)) + " >>"
+            kids.append(node)
+            count -= step
+        return kids
+    pages_id = new_obj_id()
+    objs[pages_id] = None
+    kids = add_pages(pages_id,pages)
+    objs[pages_id] = "<< /Type /Pages /Kids [ " + " ".join(str(i) + " 0 R" for i in kids) + " ] /Count " + str(pages) + " >>"
+    items = []
+    for i in range(objects):
+        item = new_obj_id()
+        objs[item] = "<< /Type /BenchItem /Index " + str(i) + " /Data (item " + str(i) + ") >>"
+        items.append(item)
+    extra = ""
+    if objects > 0:
+        items_id = new_obj_id()
+        objs[items_id] = "[ " + " ".join(str(i) + " 0 R" for i in items) + " ]"
+        extra = " /BenchItems " + str(items_id) + " 0 R"
+    objs[catalog] = "<< /Type /Catalog /Pages " + str(pages_id) + " 0 R" + extra + " >>"
+    out = ["%PDF-1.4\n"]
+    pos = len(out[0])
+    offsets = {}
+    for obj_id in sorted(objs):
+        offsets[obj_id] = pos
+        out.append(str(obj_id) + " 0 obj\n" + objs[obj_id] + "\nendobj\n")
+        pos += len(out[-1])
+    size = len(objs) + 1
+    out.append("xref\n0 " + str(size) + "\n0000000000 65535 f \n")
+    for obj_id in range(1,size):
+        out.append("%010d 00000 n \n" % offsets[obj_id])
+    out.append("trailer\n<< /Size " + str(size) + " /Root " + str(catalog) + " 0 R /Info " + str(info) + " 0 R >>\nstartxref\n" + str(pos) + "\n%%EOF\n")
+    f = open(filename,'wb')
+    f.write(''.join(out))
+    f.close()
+    return filename
+
+def format_bytes(size):
+    return str(round(size/1024.,1)) + " KiB"
+
+def bench_memory(filename):
+    '''compare the memory held per object by the index and the object handles
+    against the dictionary layout they replace: a dict of (offset,gen_id,stream_id)
+    tuples for the index and, per object, an instance __dict__ holding its own
+    copy of the source'''
+    pdf = PDF(filename,lazy=True)
+    xref = pdf.xref
+    legacy_index = dict((obj_id,xref[obj_id]) for obj_id in xref)
+    legacy_index_size = sys.getsizeof(legacy_index) + sum(sys.getsizeof(i) for i in legacy_index.itervalues())
+    class LegacyObject(object):
+        pass
+    legacy_size = 0
+    handle_size = 0
+    for obj in pdf.iter_objs():
+        legacy = LegacyObject()
+        legacy.__dict__.update(parent=pdf,content=obj.content,obj_id=obj.obj_id,gen_id=obj.gen_id,is_trailer=False,obj_type=None,value=None)
+        legacy_size += sys.getsizeof(legacy) + sys.getsizeof(legacy.__dict__) + sys.getsizeof(legacy.content)
+        handle_size += sys.getsizeof(obj)
+    print "objects:",len(xref)
+    print "index:   dict",format_bytes(legacy_index_size),"  table",format_bytes(xref.memory_size())
+    print "handles: dict",format_bytes(legacy_size),"  slots",format_bytes(handle_size)
+    pdf.close()
+
+def bench_load(filename,repeat=3):
+    for lazy in (False,True):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            pdf = PDF(filename,lazy=lazy)
+            pdf.get_page_count()
+            elapsed = time.time() - start
+            pdf.close()
+            if best is None or elapsed < best:
+                best = elapsed
+        print "load (lazy=" + str(lazy) + "):",round(best,4),"s"
+
+def bench_decode(filename,workers=(2,4,8)):
+    '''time opening the file and decoding every stream, one at a time and then
+    on thread pools of each size in <workers>'''
+    start = time.time()
+    pdf = PDF(filename)
+    count = 0
+    for obj in pdf.iter_objs():
+        if obj.obj_type == PDF_TYPE_STREAM and obj.value.get_filters()[0]:
+            obj.value['stream_decoded']
+            count += 1
+    serial = time.time() - start
+    pdf.close()
+    print "decode:",count,"streams, serial",round(serial,4),"s"
+    for n in workers:
+        start = time.time()
+        pdf = PDF(filename,decode_workers=n)
+        elapsed = time.time() - start
+        pdf.close()
+        print "        " + str(n),"workers",round(elapsed,4),"s, speedup",round(serial/elapsed,2)
+
+def bench_save(filename,levels=(None,1,6,9)):
+    '''time a rewrite of the file at each zlib level, with and without object
+    streams, and report the size of the output'''
+    temp_dir = tempfile.mkdtemp()
+    output = os.path.join(temp_dir,'bench_save_output.pdf')
+    print "save: level     objstm   size         time"
+    try:
+        for level in levels:
+            for object_streams in (False,True):
+                pdf = PDF(filename,lazy=True)
+                try:
+                    start = time.time()
+                    pdf.save(output,mode='rewrite',compress_level=level,object_streams=object_streams)
+                    elapsed = time.time() - start
+                finally:
+                    pdf.close()
+                print "      " + str(level).ljust(9),str(object_streams).ljust(8),format_bytes(os.path.getsize(output)).ljust(12),round(elapsed,4),"s"
+    finally:
+        shutil.rmtree(temp_dir,True)
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#    Suite cases, each returns (seconds,operations) for one
+#    run, with any setup it needs left out of the timing
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+BENCH_QUAD = [72,730,144,730,72,716,144,716]
+BENCH_RECT = [72,716,144,730]
+
+def case_load(filename):
+    start = time.time()
+    PDF(filename).close()
+    return time.time() - start,1
+
+def case_load_lazy(filename):
+    start = time.time()
+    PDF(filename,lazy=True).close()
+    return time.time() - start,1
+
+def case_get_obj(filename):
+    pdf = PDF(filename,lazy=True)
+    try:
+        obj_ids = list(pdf.xref)
+        start = time.time()
+        for obj_id in obj_ids:
+            pdf.get_obj(obj_id,pdf.xref.get_gen_id(obj_id)).value
+        return time.time() - start,len(obj_ids)
+    finally:
+        pdf.close()
+
+def case_get_page(filename):
+    pdf = PDF(filename,lazy=True)
+    try:
+        count = pdf.get_page_count()
+        start = time.time()
+        for page_no in range(1,count+1):
+            pdf.get_page(page_no)
+        return time.time() - start,count
+    finally:
+        pdf.close()
+
+def case_get_page_text(filename):
+    pdf = PDF(filename,lazy=True)
+    try:
+        count = pdf.get_page_count()
+        start = time.time()
+        for page_no in range(1,count+1):
+            pdf.get_page_text(page_no)
+        return time.time() - start,count
+    finally:
+        pdf.close()
+
+def case_add_annot_to_page(filename):
+    pdf = PDF(filename,lazy=True)
+    try:
+        count = pdf.get_page_count()
+        start = time.time()
+        for page_no in range(1,count+1):
+            pdf.add_annot_to_page(page_no,BENCH_QUAD,BENCH_RECT)
+        return time.time() - start,count
+    finally:
+        pdf.close()
+
+def _time_save(filename,mode):
+    pdf = PDF(filename,lazy=True)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for page_no in range(1,pdf.get_page_count()+1):
+            pdf.add_annot_to_page(page_no,BENCH_QUAD,BENCH_RECT)
+        start = time.time()
+        pdf.save(os.path.join(temp_dir,'bench_save.pdf'),mode=mode)
+        return time.time() - start,1
+    finally:
+        pdf.close()
+        shutil.rmtree(temp_dir,True)
+
+def case_save_append(filename):
+    return _time_save(filename,'append')
+
+def case_save_rewrite(filename):
+    return _time_save(filename,'rewrite')
+
+BENCH_CASES = OrderedDict([
+    ('load',case_load),
+    ('load_lazy',case_load_lazy),
+    ('get_obj',case_get_obj),
+    ('get_page',case_get_page),
+    ('get_page_text',case_get_page_text),
+    ('add_annot_to_page',case_add_annot_to_page),
+    ('save_append',case_save_append),
+    ('save_rewrite',case_save_rewrite),
+])
+
+# Cases faster than this are not reported as regressions, their timings are
+# mostly noise
+BENCH_MIN_SECONDS = 0.005
+
+def get_peak_rss():
+    '''return the peak resident memory of this process in KiB, or None where the
+    resource module is not available'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+def _run_case(queue,case,filename,repeat):
+    try:
+        start_rss = get_peak_rss()
+        best = None
+        for i in range(repeat):
+            seconds,ops = BENCH_CASES[case](filename)
+            if best is None or seconds < best:
+                best = seconds
+        peak = get_peak_rss()
+        if peak is not None:
+            peak -= start_rss
+        queue.put((best,ops,peak,None))
+    except Exception as e:
+        queue.put((None,None,None,str(e)))
+
+def run_case(case,filename,repeat=3):
+    '''run <case> on <filename> <repeat> times in a new process, returns a
+    dictionary of the best time, the operations in each run and the peak memory
+    the process used above what it started with'''
+    queue = Queue()
+    process = Process(target=_run_case,args=(queue,case,filename,repeat))
+    process.start()
+    seconds,ops,peak,error = queue.get()
+    process.join()
+    result = OrderedDict([('seconds',seconds),('ops',ops),('peak_kib',peak)])
+    if error is not None:
+        result['error'] = error
+    return result
+
+def run_suite(files,repeat=3,cases=None):
+    '''run each of <cases>, all of BENCH_CASES by default, on each of <files>
+    and return the results keyed by file name and case'''
+    if cases is None:
+        cases = BENCH_CASES.keys()
+    results = OrderedDict()
+    for filename in files:
+        pdf = PDF(filename,lazy=True)
+        info = OrderedDict([('size',os.path.getsize(filename)),('pages',pdf.get_page_count()),('objects',pdf.get_obj_count()),('cases',OrderedDict())])
+        pdf.close()
+        for case in cases:
+            result = run_case(case,filename,repeat)
+            info['cases'][case] = result
+            print >>sys.stderr, os.path.basename(filename).ljust(20),case.ljust(18),format_result(result)
+        results[os.path.basename(filename)] = info
+    return results
+
+def format_result(result):
+    if 'error' in result:
+        return "error: " + result['error']
+    text = str(round(result['seconds'],4)) + " s"
+    if result['ops'] > 1:
+        text += ", " + str(round(1e6*result['seconds']/result['ops'],1)) + " us/op"
+    if result['peak_kib'] is not None:
+        text += ", peak " + format_bytes(1024*result['peak_kib'])
+    return text
+
+def compare_baseline(results,baseline,threshold=1.25):
+    '''add the baseline time and the ratio to it to each case in <results> that
+    <baseline> also has, returns a list of (file,case,ratio) for the cases more
+    than <threshold> times slower than the baseline'''
+    regressions = []
+    for name in results:
+        base_cases = baseline.get('files',{}).get(name,{}).get('cases',{})
+        for case,result in results[name]['cases'].iteritems():
+            base = base_cases.get(case)
+            if base is None or not base.get('seconds') or result.get('seconds') is None:
+                continue
+            ratio = result['seconds']/base['seconds']
+            result['baseline_seconds'] = base['seconds']
+            result['ratio'] = round(ratio,3)
+            flag = ""
+            if ratio > threshold and result['seconds'] - base['seconds'] > BENCH_MIN_SECONDS:
+                regressions.append((name,case,ratio))
+                flag = "  REGRESSION"
+            print >>sys.stderr, name.ljust(20),case.ljust(18),str(round(base['seconds'],4)).rjust(8),"->",str(round(result['seconds'],4)).rjust(8),"s  x" + str(round(ratio,2)) + flag
+    return regressions
+
+def run_reports(files):
+    '''print the detailed memory, load, decode and save breakdowns'''
+    for filename in files:
+        print filename
+        bench_memory(filename)
+        bench_load(filename)
+        bench_decode(filename)
+        bench_save(filename)
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-p","--pages",dest="pages",type="int",default=500)
+    parser.add_option("-n","--objects",dest="objects",type="int",default=0)
+    parser.add_option("-u","--uncompressed",dest="compress",action="store_false",default=True)
+    parser.add_option("-s","--stream-size",dest="stream_size",type="int",default=400)
+    parser.add_option("-r","--repeat",dest="repeat",type="int",default=3)
+    parser.add_option("-c","--case",dest="cases",action="append",help="run only this case, may be given more than once")
+    parser.add_option("-o","--output",dest="output",help="write the JSON results to this file rather than stdout")
+    parser.add_option("-b","--baseline",dest="baseline",help="compare against the JSON results of an earlier run")
+    parser.add_option("-t","--threshold",dest="threshold",type="float",default=1.25)
+    parser.add_option("--report",dest="report",action="store_true",default=False,help="print the detailed breakdowns instead")
+    (opts,args) = parser.parse_args()
+    for case in opts.cases or []:
+        if case not in BENCH_CASES:
+            parser.error("unknown case " + case + ", choose from " + ", ".join(BENCH_CASES))
+    # synthetic files are made in a directory of their own, removed afterwards,
+    # and keep the same name from run to run so results match the baseline
+    temp_dir = tempfile.mkdtemp()
+    try:
+        if len(args) > 0:
+            files = args
+        else:
+            files = [make_pdf(os.path.join(temp_dir,'bench_' + str(opts.pages) + '.pdf'),opts.pages,stream_size=opts.stream_size,compress=opts.compress,objects=opts.objects)]
+            bundled = os.path.join(os.path.dirname(os.path.abspath(__file__)),'stream_test.pdf')
+            if os.path.exists(bundled):
+                files.append(bundled)
+        if opts.report:
+            run_reports(files)
+            sys.exit(0)
+        results = OrderedDict([('python',sys.version.split()[0]),('repeat',opts.repeat),('files',run_suite(files,opts.repeat,opts.cases))])
+    finally:
+        shutil.rmtree(temp_dir,True)
+    regressions = []
+    if opts.baseline is not None:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_baseline(results['files'],baseline,opts.threshold)
+    output = json.dumps(results,indent=2)
+    if opts.output is not None:
+        with open(opts.output,'w') as f:
+            f.write(output + "\n")
+    else:
+        print output
+    if len(regressions) > 0:
+        print >>sys.stderr, len(regressions),"case(s) slower than",opts.threshold,"times the baseline"
+        sys.exit(1)
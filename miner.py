@@ -44,6 +44,7 @@ for page in PDFPage.create_pages(document):
     interpreter.process_page(page)
     # receive the LTPage object for the page.
     layout = device.get_result()
+    annots = []
     for group in layout.groups:
         rect = [group.x0,group.y0,group.x1,group.y1]
         quad = [
@@ -52,7 +53,8 @@ for page in PDFPage.create_pages(document):
                 group.x1,group.y1,
                 group.x0,group.y1
                 ]
-        pdf.add_annot_to_page(page_no,quad,rect)
+        annots.append((quad,rect))
+    pdf.add_annots(page_no,annots)
     page_no += 1
 
 try:
@@ -1,5 +1,10 @@
-import sys, re
+import os, sys, re, mmap, zlib, shutil, time, marshal, hashlib, tempfile
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+from bisect import bisect_right
 from pdf_utils import * 
+from pdf_text import *
 from optparse import OptionParser
 
 
@@ -25,14 +30,16 @@ from optparse import OptionParser
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # 
 #    To do:
 #        [ ] Add page
-#        [ ] Write parsers to eliminate need for regex
+#        [-] Write parsers to eliminate need for regex
+#            [+] Lexer for objects
 #        [ ] Write text content
 #        [ ] Edit/Update objs
 #        [-] Annotations
 #            [+] Properly Adding Annotations
 #            [+] Highlighting
-#        [ ] Text locating
-#            [ ] Search functions
+#        [-] Text locating
+#            [+] Positioned text runs
+#            [+] Search functions
 #        [+] Objectify all of PDF
 #        [ ] Meta Data
 #        [-] Decode Streams
@@ -49,23 +56,241 @@ class PDFMeta(object):
         self.info = info
         self.parent = parent
 
+class PDFPageTree(object):
+    '''index of the page tree under the /Pages object <root>.  A /Pages node is
+    read the first time a lookup passes through it, recording each kid along
+    with the number of the first page below it, worked out from the /Count of
+    nested nodes.  A page is found by a bisect at each level on the way down,
+    so only the nodes on its path are loaded, and the /Kids arrays of the
+    document are never modified'''
+    def __init__(self,parent,root):
+        self.parent = parent
+        self.root = (root.obj_id,root.gen_id)
+        self.nodes = {}
+        self.counted = False
+
+    def _read_node(self,obj_id,gen_id,path,trust_count=True):
+        '''return (kids,starts,count) for the /Pages node <obj_id>, where kids
+        holds (obj_id,gen_id,is_page) for each kid and starts the index of the
+        first page under each.  <path> holds the nodes above, to catch cycles.
+        Unless <trust_count> is set, nested nodes are read too and counted
+        rather than relying on their /Count'''
+        node = self.nodes.get(obj_id)
+        if node is not None:
+            return node
+        if len(path) > PDF_MAX_NESTING:
+            raise PDFFormatError("Page tree is nested more than " + str(PDF_MAX_NESTING) + " levels deep")
+        kids = resolve_pdf_value(self.parent.get_obj(obj_id,gen_id).attr('/Kids'))
+        if not isinstance(kids,list):
+            raise PDFFormatError("/Pages object " + str(obj_id) + " does not have a valid /Kids array.  File may be damaged and cannot be indexed.")
+        entries = []
+        starts = []
+        count = 0
+        for kid in kids:
+            try:
+                if not isinstance(kid,PDFObject):
+                    kid = self.parent.get_obj(kid)
+                if kid.has_attr('/Type','/Pages') or (kid.has_attr('/Kids') and not kid.has_attr('/Type','/Page')):
+                    if kid.obj_id in path:
+                        raise PDFFormatError("")
+                    kid_count = resolve_pdf_value(kid.attr('/Count'))
+                    if not trust_count or not isinstance(kid_count,(int,long)) or kid_count < 0:
+                        kid_count = self._read_node(kid.obj_id,kid.gen_id,path + (kid.obj_id,),trust_count)[2]
+                    entries.append((kid.obj_id,kid.gen_id,False))
+                elif kid.has_attr('/Type','/Page'):
+                    kid_count = 1
+                    entries.append((kid.obj_id,kid.gen_id,True))
+                else:
+                    raise PDFFormatError("")
+            except (PDFFormatError,PDFOperationError):
+                if isinstance(kid,PDFObject):
+                    kid = kid.indirect_ref()
+                print "Warning: Object " + str(kid) + " was found not to be of /Type /Page or /Type /Pages and is therefore invalid for indexing. File may be damaged..."
+                continue
+            starts.append(count)
+            count += kid_count
+        node = (entries,starts,count)
+        self.nodes[obj_id] = node
+        return node
+
+    def index_all(self):
+        '''read every node of the tree, counting the pages actually found below
+        each node in place of the /Count entries'''
+        self.nodes = {}
+        self.counted = True
+        obj_id,gen_id = self.root
+        self._read_node(obj_id,gen_id,(obj_id,),False)
+
+    def _read_root(self):
+        '''return (kids,starts,count) for the root node.  When its /Count does not
+        match the total of its kids the whole tree is counted'''
+        obj_id,gen_id = self.root
+        node = self.nodes.get(obj_id)
+        if node is None:
+            node = self._read_node(obj_id,gen_id,(obj_id,))
+            if not self.counted and resolve_pdf_value(self.parent.get_obj(obj_id,gen_id).attr('/Count')) != node[2]:
+                self.index_all()
+                node = self.nodes[obj_id]
+        return node
+
+    def get_page_id(self,page_no):
+        '''return (obj_id,gen_id) of page number <page_no>, counting from 1.  When
+        a node turns out to hold a different number of pages than its /Count,
+        or the page is not found, the whole tree is counted and the lookup
+        tried again'''
+        index = page_no - 1
+        obj_id,gen_id = self.root
+        path = (obj_id,)
+        expected = None
+        while True:
+            if len(path) == 1:
+                kids,starts,count = self._read_root()
+            else:
+                kids,starts,count = self._read_node(obj_id,gen_id,path)
+            if index < 0 or index >= count or (expected is not None and count != expected):
+                break
+            i = bisect_right(starts,index) - 1
+            obj_id,gen_id,is_page = kids[i]
+            if i+1 < len(starts):
+                expected = starts[i+1] - starts[i]
+            else:
+                expected = count - starts[i]
+            index -= starts[i]
+            if is_page:
+                if index == 0:
+                    return obj_id,gen_id
+                break
+            path += (obj_id,)
+        if page_no >= 1 and not self.counted:
+            self.index_all()
+            return self.get_page_id(page_no)
+        raise KeyError(page_no)
+
+    def __len__(self):
+        return self._read_root()[2]
+
+    def __str__(self):
+        return str(self.nodes)
+
 class PDFObject(object):
-    def __init__(self,parent,content,is_trailer=False,register=False,*args,**kwargs):
+    __slots__ = ('parent','_content','offset','length','stream_id','is_trailer','obj_id','gen_id','_obj_type','_value','_parsed')
+
+    def __init__(self,parent,content,is_trailer=False,register=False,offset=None,length=None,obj_id=None,gen_id=0,stream_id=None,*args,**kwargs):
+        '''an object is created either from its PDF source in <content>, or with
+        content None as a view of <length> bytes at <offset> in parent.content.
+        Objects kept in an object stream are views into the decoded stream
+        <stream_id>, and as they carry no header are given <obj_id> and <gen_id>.
+        Those with no <offset> yet are found in the stream when first needed'''
         self.parent  = parent
-        self.content = content
+        self._content = content
+        self.offset = offset
+        self.length = length
+        self.stream_id = stream_id
         self.is_trailer = is_trailer
-        if not is_trailer:
-            try:
-                matches = re.findall(r'(\d+) (\d+) obj',content)
-                self.obj_id = int(matches[0][0])
-                self.gen_id = int(matches[0][1])
-            except:
+        if obj_id is not None:
+            self.obj_id = obj_id
+            self.gen_id = gen_id
+        elif not is_trailer:
+            if content is None:
+                header = PDF_OBJ_HEADER_REGEX.match(parent.content,offset)
+            else:
+                header = PDF_OBJ_HEADER_REGEX.match(content)
+            if header is None:
                 raise PDFOperationError("Attempt to create instance of PDFObject from non-pdf object")
-        self.obj_type = get_pdf_obj_type(content)
-        self.value = pdf_obj_to_py_obj(self)
+            self.obj_id = int(header.group(1))
+            self.gen_id = int(header.group(2))
+        self._obj_type = None
+        self._value = None
+        self._parsed = False
         if register:
             self.parent.register(self)
-    
+
+    @classmethod
+    def from_value(cls,parent,obj_id,gen_id,value,register=False,is_trailer=False):
+        '''create an object numbered <obj_id> holding the python <value> as it is,
+        rather than parsing it from PDF source'''
+        obj = cls(parent,None,is_trailer=is_trailer,obj_id=obj_id,gen_id=gen_id)
+        obj._value = value
+        obj._obj_type = py_obj_to_pdf_type(value)
+        obj._parsed = True
+        if isinstance(value,PDFStream):
+            value.cache = parent.stream_cache
+            value.max_size = parent.max_stream_size
+        if register:
+            parent.register(obj)
+        return obj
+
+    def _get_content(self):
+        if self._content is None:
+            data,start,end = self._get_source()
+            if self.offset is None or self.stream_id is None:
+                return data[start:end]
+            return str(self.obj_id) + " " + str(self.gen_id) + " obj\n" + data[start:end].strip() + "\nendobj"
+        return self._content
+
+    def _set_content(self,content):
+        self._content = content
+        self.offset = None
+        self.length = None
+        self.stream_id = None
+
+    content = property(_get_content,_set_content)
+
+    def _get_source(self):
+        '''return the buffer holding the source of the object and the bounds of
+        the object within it'''
+        if self._content is not None:
+            return self._content,0,len(self._content)
+        if self.offset is None and self.stream_id is not None:
+            self.parent._locate_member(self)
+        if self.offset is None:
+            content = self.to_pdf_obj()
+            return content,0,len(content)
+        if self.stream_id is None:
+            return self.parent.content,self.offset,self.offset+self.length
+        return self.parent._get_obj_stream(self.stream_id),self.offset,self.offset+self.length
+
+    # The type and value of an object are only worked out the first time they
+    # are asked for, links to other objects are resolved at the same time
+
+    def _get_obj_type(self):
+        if self._obj_type is None:
+            self._obj_type = classify_pdf_obj(*self._get_source())
+        return self._obj_type
+
+    def _set_obj_type(self,obj_type):
+        self._obj_type = obj_type
+
+    obj_type = property(_get_obj_type,_set_obj_type)
+
+    def _get_value(self):
+        if not self._parsed:
+            self._materialize()
+        return self._value
+
+    def _set_value(self,value):
+        self._value = value
+        self._parsed = True
+
+    value = property(_get_value,_set_value)
+
+    def _materialize(self):
+        '''parse the content of the object and link it to the objects it references,
+        returns the number of links made'''
+        if self.parent is None:
+            self._obj_type,self._value = parse_pdf_obj(*self._get_source())
+            self._parsed = True
+            return 0
+        self._obj_type,self._value = self.parent._parse_obj(self)
+        self._parsed = True
+        if isinstance(self._value,PDFStream):
+            self._value.cache = self.parent.stream_cache
+            self._value.max_size = self.parent.max_stream_size
+        return self.parent._optimize(self)
+
+    def is_parsed(self):
+        return self._parsed
+
     def __unicode__(self):
         return self.__str__()
 
@@ -129,7 +354,11 @@ class PDFObject(object):
         return py_obj_to_pdf_obj(self,PDFObject=PDFObject)
 
     def copy(self):
-        return PDFObject(self.parent,self.content,is_trailer=self.is_trailer,register=True)
+        '''return a registered copy of the object, its dictionaries and arrays are
+        copied while links to other objects are kept'''
+        if self.is_trailer:
+            return PDFObject.from_value(self.parent,None,0,copy_pdf_value(self.value),register=True,is_trailer=True)
+        return PDFObject.from_value(self.parent,self.obj_id,self.gen_id,copy_pdf_value(self.value),register=True)
 
     def edit(self,action,value=None):
         copy = self.copy()
@@ -150,82 +379,439 @@ class PDFObject(object):
             copy.obj_id = value
         elif action == 'content':
             copy.content = value
-            copy.obj_type = get_pdf_obj_type(copy.content)
+            copy.obj_type = None
+            copy._parsed = False
         else:
             copy.value[action] = value
         return copy
     
 
 class PDF:
-    def __init__(self,filename,verbose=False,debug=False,vv=False):
+    def __init__(self,filename,verbose=False,debug=False,vv=False,lazy=False,stream_cache_size=DEFAULT_STREAM_CACHE_BYTES,memory_map=False,decode_workers=0,max_stream_size=None,cache_dir=None):
         '''initialization of PDF object, with verbose,debug,vv (very verbose),
         options for levels of printed output information, generally I imagine these
         will rarely be called when not being used as a command line tool.  Takes a
         filename/path as an argument, reads the doc and attempts to create a PDF
         object out of the file, calls all initialization methods, setting page
-        reference and object reference'''
+        reference and object reference.  With lazy set, objects are only read
+        and parsed from the file the first time they are accessed.  Decoded
+        streams are kept in a cache of at most stream_cache_size bytes.  With
+        memory_map set the file is mapped into memory rather than read, objects
+        not yet parsed only refer to their offsets in it so untouched pages stay
+        on disk.  This pays off together with lazy, as parsing a stream copies
+        its raw data out of the map.  Without lazy every object is parsed on
+        load, so the data of every stream is held in memory as well as mapped.
+        With decode_workers set every stream is decoded up front on that many
+        threads, see decode_streams.  Decoding a stream to more than
+        max_stream_size bytes raises a PDFOperationError, guarding against
+        decompression bombs.  With cache_dir set the object index, page tree
+        index and small parsed objects are kept in a file there, and later
+        opens of the unchanged file read them back rather than parsing it'''
         if debug: print "Creating PDF Object..."
+        self._map = None
         try:
             if debug: print "Reading File...",
             with open(filename,'rb') as f:
-                self.content = ''.join(i for i in f)
+                if memory_map:
+                    self._map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+                    self.content = self._map
+                else:
+                    self.content = f.read()
             if debug: print "complete."
         except IOError:
             raise PDFOperationError("Unable to read file.  File may not exist or may be damaged")
         except:
             raise PDFOperationError("Unable to read file.  File may not exist or may be damaged")
-        self.edited_objs = []
+        self.edited_objs = OrderedDict()
         self.debug = debug
         self.verbose = verbose or debug
         self.vv = vv
+        self.lazy = lazy
+        self.stream_cache = PDFStreamCache(stream_cache_size)
+        self.max_stream_size = max_stream_size
+        self.text_interpreter = PDFTextInterpreter(self)
+        self.text_index = {}
         self.filename = filename
-        self._set_obj_ref()
-        self._set_page_ref()
+        self.cache_dir = cache_dir
+        self.cached_values = {}
+        self.cache_key = None
+        cache = None
+        if cache_dir is not None:
+            cache = self._read_cache()
+        self._set_obj_ref(cache)
+        self._set_page_ref(cache)
         self._get_meta_data()
+        if cache_dir is not None and cache is None:
+            self._write_cache()
+        if decode_workers > 0:
+            self.decode_streams(decode_workers)
         if self.debug or self.verbose:
             print "PDF Object created from file:",self.filename
             self.print_info()
 
-    # Note: May want to account for broken PDF objects
-    def _set_obj_ref(self):
+    def _set_obj_ref(self,cache=None):
         '''set the object reference dictionary, and turn all PDF objects into python
-        objects.  This method ignores non-valid PDF objects'''
+        objects.  Objects are located through the cross-reference table, falling
+        back to a scan of the whole file when the table is missing or damaged,
+        or through the index in the parse <cache> when there is one'''
         if self.verbose or self.debug: print "Indexing PDF objects...",
-        objs = re.findall(r'((\d+) (\d+) obj.*?endobj)',self.content,re.S)
         self.obj_ref = {}
-        self.next_obj_id = -1
-        self.next_gen_id = 0
-        for i in objs:
+        self.xref = PDFObjectTable()
+        if cache is not None:
+            self.xref = cache['xref']
+            self.obj_streams = {}
+            self.obj_stream_members = {}
+            self.trailer_content = cache['trailer']
+            self.startxref = cache['startxref']
+            self.cached_values = cache['values']
+        else:
             try:
-                temp = int(i[1])
-                self.obj_ref[str(temp)+"-"+i[2]] = PDFObject(self,i[0])
-                self.next_obj_id = max(self.next_obj_id,temp)
-                try:
-                    self.next_gen_id = max(int(i[2]),self.next_gen_id)
-                except Exception as e:
-                    if self.debug:
-                        print "Error setting gen id",e
-                        print "value",i
-                        raise e
+                self._read_xref()
+            except PDFFormatError as e:
+                if self.verbose or self.debug: print "cross-reference table unusable (" + str(e) + "), repairing...",
+                self._scan_xref()
+        self.next_obj_id = self.xref.max_obj_id() + 1
+        self.next_gen_id = self.xref.max_gen_id() + 1
+        if self.verbose or self.debug: print "complete:",len(self.xref),"objects indexed."
+        if self.lazy:
+            return
+        for obj_id in self.xref:
+            try:
+                self._load_obj(obj_id)
             except Exception as e:
                 if self.debug:
                     print "Error:",e
-                    print "setting object reference on",i[1]+"-"+i[2],":"
-                    print "\t",i[0].replace("\t","").replace("\n","\n\t")
+                    print "setting object reference on",obj_id,"at offset",self.xref[obj_id][0]
                     raise e
-        self.next_obj_id += 1
-        self.next_gen_id += 1
-        if self.verbose or self.debug: print "complete:",len(self.obj_ref),"objects indexed."
         if self.verbose or self.debug: print "Optimizing PDFObject links...",
         c = self._optimize_obj_ref()
         if self.verbose or self.debug: print "complete.",c,"links optimized."
-    
+
+    def _load_obj(self,obj_id):
+        '''read the object numbered <obj_id> from its offset in the file and add it
+        to the object reference dictionary, its value is parsed on first access'''
+        offset,gen_id,stream_id = self.xref[obj_id]
+        if stream_id is None:
+            obj = PDFObject(self,None,offset=offset,length=find_obj_end(self.content,offset)-offset)
+        else:
+            obj = PDFObject(self,None,obj_id=obj_id,gen_id=gen_id,stream_id=stream_id)
+            cached = self.cached_values.get(obj_id)
+            if cached is not None and cached[0] == offset and cached[1] == stream_id:
+                # the value is in the parse cache, so the object stream is only
+                # decoded if the source of the object is asked for
+                obj.obj_type = cached[2]
+            else:
+                self._locate_member(obj)
+        self.obj_ref[obj_id] = obj
+        return obj
+
+    def _locate_member(self,obj):
+        '''set the offset and length of <obj> within the decoded data of its object
+        stream, from the member index in its xref entry'''
+        index = self.xref[obj.obj_id][0]
+        self._get_obj_stream(obj.stream_id)
+        member_id,start,end = self.obj_stream_members[obj.stream_id][index]
+        if member_id != obj.obj_id:
+            raise PDFFormatError("Object stream " + str(obj.stream_id) + " does not hold object " + str(obj.obj_id) + " at index " + str(index))
+        obj.offset = start
+        obj.length = end - start
+
+    def _get_obj_stream(self,stream_id):
+        '''return the decoded content of the object stream numbered <stream_id>,
+        each object stream is only decoded once'''
+        try:
+            return self.obj_streams[stream_id]
+        except KeyError:
+            pass
+        stream = self.get_obj(stream_id,self.xref.get_gen_id(stream_id)).value
+        if not isinstance(stream,PDFStream) or stream.get('/Type') != '/ObjStm':
+            raise PDFFormatError("Object " + str(stream_id) + " is not an object stream")
+        data = stream.decode()
+        self.obj_stream_members[stream_id] = parse_obj_stream(data,resolve_pdf_value(stream['/N']),resolve_pdf_value(stream['/First']))
+        self.obj_streams[stream_id] = data
+        return data
+
+    def _load_all(self):
+        '''make sure every object in the file has been loaded'''
+        for obj_id in self.xref:
+            if obj_id not in self.obj_ref:
+                self._load_obj(obj_id)
+
+    def decode_streams(self,workers=4):
+        '''decode every filtered stream in the document on a pool of <workers>
+        threads and keep the results in the stream cache.  zlib releases the GIL
+        while it inflates, so the streams are decoded side by side.  Streams are
+        decoded a batch at a time and decoding stops once the cache is full, as
+        anything more would only push out what was just decoded.  Returns the
+        number of streams decoded'''
+        streams = []
+        for obj in self.iter_objs():
+            try:
+                value = obj.value
+            except PDFOperationError:
+                continue
+            if not isinstance(value,PDFStream) or value.get('/Type') in ('/ObjStm','/XRef'):
+                continue
+            # filters are resolved here, as following references is not thread safe
+            filters,parms = value.get_filters()
+            # image codecs are not decoded here, caching their data would only
+            # push content streams out of the cache
+            if filters and not is_image_filter(filters):
+                streams.append((value,filters,parms))
+        if len(streams) == 0:
+            return 0
+        if self.verbose or self.debug: print "Decoding",len(streams),"streams on",workers,"threads...",
+        pool = ThreadPool(workers)
+        count = 0
+        full = False
+        try:
+            for start in xrange(0,len(streams),workers*PDF_DECODE_BATCH_SIZE):
+                batch = streams[start:start+workers*PDF_DECODE_BATCH_SIZE]
+                results = pool.map(_decode_stream,[(value['stream'],filters,parms,value.max_size) for value,filters,parms in batch])
+                for (value,filters,parms),data in zip(batch,results):
+                    if data is None:
+                        continue
+                    if not self.stream_cache.has_room(len(data)):
+                        full = True
+                        break
+                    self.stream_cache.put(value.key,data)
+                    count += 1
+                if full:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+        if self.verbose or self.debug:
+            print "complete."
+            if full:
+                print "Stream cache of",self.stream_cache.max_bytes,"bytes is full,",len(streams) - count,"streams left to decode when used"
+        return count
+
+    def iter_objs(self):
+        '''iterate over every PDFObject in the document, loading them as needed'''
+        self._load_all()
+        for obj_id in self.obj_ref.keys():
+            yield self.obj_ref[obj_id]
+
+    def _read_xref(self):
+        '''build the object offset index from the cross-reference tables, starting
+        at startxref and following the /Prev chain, newer sections take precedence
+        over older ones'''
+        xref = {}
+        trailers = []
+        visited = set()
+        offset = find_startxref(self.content)
+        while offset is not None:
+            if offset in visited:
+                raise PDFFormatError("Cross-reference /Prev chain loops back to offset " + str(offset))
+            visited.add(offset)
+            if self.content[offset:offset+4] == 'xref':
+                entries,trailer = parse_xref_section(self.content,offset)
+                stream_offset = get_xref_stm(trailer)
+                if stream_offset is not None:
+                    stream_entries = parse_xref_stream(self.content,stream_offset)[0]
+                    for obj_id in stream_entries:
+                        if entries.get(obj_id) is None:
+                            entries[obj_id] = stream_entries[obj_id]
+            else:
+                entries,trailer = parse_xref_stream(self.content,offset)
+            for obj_id in entries:
+                if obj_id not in xref:
+                    xref[obj_id] = entries[obj_id]
+            trailers.append(trailer)
+            offset = get_xref_prev(trailer)
+        self.xref = PDFObjectTable(max([0] + xref.keys()) + 1)
+        self.obj_streams = {}
+        self.obj_stream_members = {}
+        for obj_id in xref:
+            if xref[obj_id] is None:
+                continue
+            offset,gen_id,stream_id = xref[obj_id]
+            if stream_id is not None:
+                self.xref[obj_id] = xref[obj_id]
+                continue
+            header = PDF_OBJ_HEADER_REGEX.match(self.content,offset)
+            if header is None or int(header.group(1)) != obj_id:
+                raise PDFFormatError("Cross-reference entry for object " + str(obj_id) + " does not point to that object")
+            self.xref[obj_id] = (offset,int(header.group(2)),None)
+        self.trailer_content = trailers[0]
+        self.startxref = find_startxref(self.content)
+
+    def _scan_xref(self):
+        '''repair the object offset index by scanning the whole file for objects,
+        used when the cross-reference table cannot be trusted'''
+        self.xref = PDFObjectTable()
+        self.obj_streams = {}
+        self.obj_stream_members = {}
+        obj_streams = []
+        xref_stream = None
+        for match in re.finditer(r'(\d+) (\d+) obj.*?endobj',self.content,re.S):
+            obj_id = int(match.group(1))
+            self.xref[obj_id] = (match.start(),int(match.group(2)),None)
+            head = self.content[match.start():min(match.start()+1024,match.end())]
+            if '/ObjStm' in head:
+                obj_streams.append(obj_id)
+            elif '/XRef' in head:
+                xref_stream = match.start()
+        for stream_id in obj_streams:
+            try:
+                self._get_obj_stream(stream_id)
+            except (PDFFormatError,PDFOperationError,zlib.error):
+                continue
+            for i,member in enumerate(self.obj_stream_members[stream_id]):
+                if member[0] not in self.xref:
+                    self.xref[member[0]] = (i,0,stream_id)
+        trailer = re.findall(r'trailer(.*?)startxref',self.content,re.S)
+        if len(trailer) > 0:
+            self.trailer_content = trailer[-1]
+        elif xref_stream is not None:
+            start = PDF_OBJ_HEADER_REGEX.match(self.content,xref_stream).end()
+            self.trailer_content = self.content[start:get_dict_end(self.content,start)]
+        else:
+            raise PDFFormatError(r'PDF does not contain a trailer, file may be damaged')
+        # the xref found at startxref is what failed to read, so nothing may point back to it
+        self.startxref = None
+
+    def _parse_obj(self,obj):
+        '''parse the source of <obj>, or take its value from the parse cache when
+        it holds one for the same place in the file'''
+        if obj.is_trailer or obj._content is not None:
+            return parse_pdf_obj(*obj._get_source())
+        cached = self.cached_values.get(obj.obj_id)
+        if cached is not None and self._is_xref_obj(obj) and cached[0] == self.xref[obj.obj_id][0] and cached[1] == obj.stream_id:
+            return cached[2],unpack_pdf_value(marshal.loads(cached[3]))
+        return parse_pdf_obj(*obj._get_source())
+
+    def _is_xref_obj(self,obj):
+        '''whether <obj> is the object the xref entry for its number points to, as
+        opposed to an edit, cache entries are keyed by the (offset,stream_id) of
+        the entry, where the offset of a member of an object stream is its index'''
+        if obj.obj_id not in self.xref:
+            return False
+        offset,gen_id,stream_id = self.xref[obj.obj_id]
+        if stream_id is None:
+            return obj.stream_id is None and obj.offset == offset
+        return obj.stream_id == stream_id
+
+    def _get_cache_path(self):
+        '''return the file in cache_dir that holds the parse cache, each file has
+        a single slot named after its real path'''
+        return os.path.join(self.cache_dir,hashlib.sha1(os.path.realpath(self.filename)).hexdigest() + '.pydf')
+
+    def _get_cache_key(self):
+        '''return the (size,mtime,sha1) of the file, a parse cache is only used
+        when all three match'''
+        if self.cache_key is None:
+            stat = os.stat(self.filename)
+            self.cache_key = (stat.st_size,stat.st_mtime,hashlib.sha1(self.content).hexdigest())
+        return self.cache_key
+
+    def _read_cache(self):
+        '''return the parse cache for the file, or None when there is none or it
+        was written for a different version of the file'''
+        try:
+            with open(self._get_cache_path(),'rb') as f:
+                cache = marshal.load(f)
+            if cache['version'] != PDF_CACHE_VERSION:
+                return None
+            if (cache['size'],cache['mtime'],cache['sha1']) != self._get_cache_key():
+                if self.verbose or self.debug: print "Parse cache is out of date."
+                return None
+            cache['xref'] = PDFObjectTable.unpack(cache['xref'])
+        except (IOError,OSError,EOFError,ValueError,TypeError,KeyError):
+            return None
+        if self.verbose or self.debug: print "Read parse cache:",len(cache['values']),"values."
+        return cache
+
+    def _write_cache(self):
+        '''write the object index, the page tree index and the parsed values of
+        small objects to the file's slot in cache_dir, see _read_cache'''
+        if self.verbose or self.debug: print "Writing parse cache...",
+        values = {}
+        for obj_id in self.xref:
+            try:
+                entry = self._get_cache_entry(obj_id)
+            except (PDFFormatError,PDFOperationError,zlib.error):
+                continue
+            if entry is not None:
+                values[obj_id] = entry
+        size,mtime,sha1 = self._get_cache_key()
+        cache = {
+            'version' : PDF_CACHE_VERSION,
+            'size' : size,
+            'mtime' : mtime,
+            'sha1' : sha1,
+            'xref' : self.xref.pack(),
+            'trailer' : self.trailer_content,
+            'startxref' : self.startxref,
+            'pages' : (self.page_tree.nodes,self.page_tree.counted),
+            'values' : values,
+        }
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # written to a temporary file first, other processes may be reading.
+            # mkstemp files are 0600, the cache is given the usual mode so that
+            # it can be shared with other users of cache_dir
+            fd,tmp = tempfile.mkstemp(dir=self.cache_dir)
+            try:
+                with os.fdopen(fd,'wb') as f:
+                    marshal.dump(cache,f)
+                os.chmod(tmp,get_new_file_mode())
+                os.rename(tmp,self._get_cache_path())
+            except:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        except (IOError,OSError) as e:
+            if self.verbose or self.debug: print "unable to write parse cache:",e
+            return
+        if self.verbose or self.debug: print "complete:",len(values),"values cached."
+
+    def _get_cache_entry(self,obj_id):
+        '''return the parse cache entry for <obj_id>, (offset,stream_id,obj_type,
+        packed value), or None for streams and objects too large to cache.  Each
+        value is marshalled on its own so that only the values used are read'''
+        offset,gen_id,stream_id = self.xref[obj_id]
+        if self.xref.get_obj_type(obj_id) == PDF_TYPE_STREAM:
+            return None
+        obj = self.obj_ref.get(obj_id)
+        if obj is not None and obj.is_parsed() and obj._content is None and self._is_xref_obj(obj):
+            if obj.length is not None and obj.length > PDF_CACHE_MAX_OBJ_SIZE:
+                return None
+            obj_type,value = obj.obj_type,obj.value
+        else:
+            if stream_id is None:
+                data,start,end = self.content,offset,find_obj_end(self.content,offset)
+            else:
+                data = self._get_obj_stream(stream_id)
+                member_id,start,end = self.obj_stream_members[stream_id][offset]
+                if member_id != obj_id:
+                    return None
+            if end - start > PDF_CACHE_MAX_OBJ_SIZE:
+                return None
+            obj_type,value = parse_pdf_obj(data,start,end)
+        if isinstance(value,PDFStream) or obj_type == PDF_TYPE_INVALID:
+            return None
+        return (offset,stream_id,obj_type,marshal.dumps(pack_pdf_value(value)))
+
     def _optimize_obj_ref(self):
         '''wrapper method to optimize all existing objs in PDF, used during
         initialization'''
         opt_count = 0
-        for obj_id in self.obj_ref:    
-            opt_count += self._optimize(self.obj_ref[obj_id])
+        for obj_id in self.obj_ref.keys():
+            obj = self.obj_ref[obj_id]
+            if obj.is_parsed():
+                continue
+            try:
+                opt_count += obj._materialize()
+            except Exception as e:
+                if self.debug:
+                    print "Error:",e
+                    print "parsing object",obj_id,":"
+                    print "\t",obj.content.replace("\t","").replace("\n","\n\t")
+                    raise e
+                del(self.obj_ref[obj_id])
         return opt_count
 
     def _optimize(self,obj):
@@ -234,84 +820,51 @@ class PDF:
         object.'''
         count = 0
         value = obj.value
-        obj_id = obj.get_obj_id()
-        if isinstance(value,basestring) and get_pdf_obj_type(value) == PDF_TYPE_REF:
-            self.obj_ref[obj_id].value = self.get_obj(value)
+        if is_pdf_ref(value):
+            obj.value = self.get_obj(value)
             count += 1
         elif isinstance(value,dict):
             for attr in value:
-                if isinstance(value[attr],basestring) and get_pdf_obj_type(value[attr]) == PDF_TYPE_REF:
-                    if obj.is_trailer:
-                        self.trailer.attr(attr,self.get_obj(value[attr]))
-                    else:
-                        self.obj_ref[obj_id].attr(attr,self.get_obj(value[attr]))
+                if is_pdf_ref(value[attr]):
+                    obj.attr(attr,self.get_obj(value[attr]))
                     count += 1
         elif isinstance(value,list):
-            for item,i in enumerate(value):
-                if isinstance(item,basestring) and get_pdf_obj_type(item) == PDF_TYPE_REF:
-                    self.obj_ref[obj_id].value[i] = self.get_obj(item)
+            for i,item in enumerate(value):
+                if is_pdf_ref(item):
+                    obj.value[i] = self.get_obj(item)
                     count += 1
-        return count    
+        return count
 
     def register(self,obj):
         '''set up a new object within an existing PDF, including indexing, and 
         optimizing links to other objects'''
         if not obj.is_trailer:
-            self.obj_ref[obj.get_obj_id()] = obj
+            self.obj_ref[obj.obj_id] = obj
+            if obj.obj_id in self.xref:
+                self.xref.set_obj_type(obj.obj_id,PDF_TYPE_UNKNOWN)
         else:
             self.trailer = obj
         self._optimize(obj)
 
-    def _set_page_ref(self):
-        '''set up a dictionary for refernce to pages by their number'''
+    def _set_page_ref(self,cache=None):
+        '''set up the index of pages by their number, see PDFPageTree'''
         if self.verbose or self.debug: print "Indexing Pages...",
-        trailer = re.findall(r'trailer(.*?)startxref',self.content,re.S)
-        if len(trailer) <= 0:
-            raise PDFFormatError(r'PDF does not contain a trailer, file may be damaged')
-        self.trailer = PDFObject(self,trailer[-1],is_trailer=True,register=True)
+        self.trailer = PDFObject(self,self.trailer_content,is_trailer=True,register=True)
         self.root = self.trailer.attr('/Root')
         if self.root is None:
             raise PDFFormatError(self.filename + " does not have a /Root.  The file may be damaged and pages cannot be indexed.")
         catalog = self.root.attr('/Pages') 
         if catalog is None:
             raise PDFFormatError(self.filename + " does not have a /Catalog.  The file may be damaged and pages cannot be indexed.")
-        pages = catalog.attr('/Kids')
-        if len(pages) <= 0:
-            raise PDFFormatError(self.filename + " does have a /Pages Object with a valid /Kids array.  File may be damaged and cannot be indexed.")
-        page_list = [] 
-        i = 0
-        while i < len(pages):
-            cur_page = pages[i]
-            obj_type = self.get_obj_type(cur_page)
-            try:
-                if obj_type == PDF_TYPE_DICT:
-                    obj = self.get_obj(cur_page)
-                    if obj.has_attr('/Type','/Pages'):
-                        pages_to_add = self._get_kids(cur_page)
-                        for j in range(len(pages_to_add)):
-                            pages.insert(i+1+j,pages_to_add[j])
-                    elif obj.has_attr('/Type','/Page'):
-                        page_list.append(obj)
-                    else:
-                        raise PDFFormatError("")
-            except PDFFormatError:
-                print "Warning: Object " + cur_page + " was found not to be of /Type /Page or /Type /Pages and is therefore invalid for indexing. File may be damaged..."    
-                print obj.content,obj.value,obj.has_attr('/Type','/Pages')
-            finally:
-                i += 1
-        if len(page_list) <= 0:
+        self.page_tree = PDFPageTree(self,catalog)
+        if cache is not None:
+            self.page_tree.nodes,self.page_tree.counted = cache['pages']
+        if not self.lazy and not self.page_tree.counted:
+            self.page_tree.index_all()
+        if len(self.page_tree) <= 0:
             raise PDFFormatError("Document was unable to be indexed.  The format could be damaged as a proper indexing could not be performed.")
-        self.page_ref = {}
-        for i in range(len(page_list)):
-            self.page_ref[i+1] = page_list[i]
-        if self.verbose or self.debug: print "complete:",len(self.page_ref),"pages indexed."
+        if self.verbose or self.debug: print "complete:",len(self.page_tree),"pages indexed."
         return
-    
-    def _get_kids(self,pages_obj_id):
-        '''get the kids of /Pages object'''
-        obj = self.get_obj(pages_obj_id)
-        kids = obj.attr('/Kids')
-        return kids
 
     def _get_meta_data(self):
         '''retrieve as much meta data as possible about the file'''
@@ -340,37 +893,57 @@ class PDF:
         '''determine the object type for object with object id <obj_id>'''
         if isinstance(obj_id,PDFObject):
             obj_id = obj_id.obj_id
+        elif isinstance(obj_id,PDFRef):
+            obj_id = obj_id.obj_id
+        if isinstance(obj_id,(int,long)) and obj_id in self.xref:
+            obj_type = self.xref.get_obj_type(obj_id)
+            if obj_type == PDF_TYPE_UNKNOWN:
+                obj_type = self.get_obj(obj_id,self.xref.get_gen_id(obj_id)).obj_type
+                self.xref.set_obj_type(obj_id,obj_type)
+            return obj_type
         return get_pdf_obj_type(self.get_obj(obj_id))
 
     def get_obj(self,obj_id,gen_id=0):
-        '''return the PDFObject that is indexed by the gen id'''
-        try:
-            if isinstance(obj_id,basestring):
-                match = re.findall(r'(\d+)( (\d+)? (R|obj)?)?',obj_id)
-                if len(match) > 0:
-                    obj_id = match[0][0]
-                    if len(match[0][2]) > 0:
-                        gen_id = match[0][2]
-            return self.obj_ref[str(obj_id)+'-'+str(gen_id)]
-        except KeyError:
-            raise PDFOperationError("The file " + self.filename + " does not contain an object numbered " + str(obj_id))
-        except ValueError:
-            raise PDFOperationError("The object number " + str(obj_id) + " is not valid.  Object numbers must be positive integers.")
-        except:
-            raise
+        '''return the PDFObject numbered <obj_id> with generation <gen_id>.  Ints
+        and parsed references are looked up directly, other text such as
+        '12 0 R' or '12-0' is parsed first'''
+        if isinstance(obj_id,PDFRef):
+            gen_id = obj_id.gen_id
+            obj_id = obj_id.obj_id
+        elif not isinstance(obj_id,(int,long)):
+            try:
+                obj_id,gen_id = parse_obj_key(obj_id,gen_id)
+            except (ValueError,TypeError):
+                raise PDFOperationError("The object number " + str(obj_id) + " is not valid.  Object numbers must be positive integers.")
+        obj = self.obj_ref.get(obj_id)
+        if obj is not None:
+            if obj.gen_id == gen_id:
+                return obj
+        elif obj_id in self.xref and self.xref.gen_ids[obj_id] == gen_id:
+            return self._load_obj(obj_id)
+        raise PDFOperationError("The file " + self.filename + " does not contain an object numbered " + str(obj_id))
 
     def get_obj_count(self):
         '''get the number of objects contained in the pdf document'''
-        return len(self.obj_ref)
+        count = len(self.xref)
+        for obj_id in self.obj_ref:
+            if obj_id not in self.xref:
+                count += 1
+        return count
 
     def get_page(self,page_no):
         '''get the PDFObject for page number <page_no>'''
-        return self.get_obj(self.get_page_obj_id(page_no))
+        return self.get_obj(*self._get_page_id(page_no))
 
     def get_page_obj_id(self,page_no):
         '''get the obj_id of the <page_no>th page'''
+        obj_id,gen_id = self._get_page_id(page_no)
+        return str(obj_id) + "-" + str(gen_id)
+
+    def _get_page_id(self,page_no):
+        '''return (obj_id,gen_id) of the <page_no>th page'''
         try:
-            return self.page_ref[int(page_no)].get_obj_id()
+            return self.page_tree.get_page_id(int(page_no))
         except ValueError:
             raise PDFOperationError("The page number '" + str(page_no) + "' provided is not a valid page number.")
         except KeyError:
@@ -378,7 +951,7 @@ class PDF:
     
     def get_page_count(self):
         '''get number of pages in the document'''
-        return len(self.page_ref)
+        return len(self.page_tree)
     
     def get_page_range(self):
         '''return the range of pages, useful to avoid 0/1 indexing confusion'''
@@ -391,65 +964,83 @@ class PDF:
     def _get_type_count(self,attr_type):
         '''get the count of objects of type <attr_type>'''
         count = 0
-        for obj_id in self.obj_ref:
-            if self.obj_ref[obj_id].attr('/Type') == attr_type:
+        for obj in self.iter_objs():
+            if obj.attr('/Type') == attr_type:
                 count += 1
         return count
 
 
     def get_edited_page(self,page_no):
-        return self.get_edited_obj(self.get_page_obj_id(page_no))
+        return self.get_edited_obj(*self._get_page_id(page_no))
         
-    def get_edited_obj(self,obj_id):
-        print obj_id
-        for i,obj in enumerate(self.edited_objs):
-            if obj_id == obj.get_obj_id():
-                return self.edited_objs.pop(i)
+    def get_edited_obj(self,obj_id,gen_id=0):
+        '''return the pending edit of object <obj_id>, or None when it has not
+        been edited since the last save'''
+        if not isinstance(obj_id,(int,long)):
+            obj_id,gen_id = parse_obj_key(obj_id,gen_id)
+        obj = self.edited_objs.get(obj_id)
+        if obj is not None and obj.gen_id == gen_id:
+            return obj
         return None
 
+    def set_edited_obj(self,obj):
+        '''record <obj> as edited, replacing any earlier edit of the same object.
+        Edits are written in the order objects were first edited'''
+        self.edited_objs[obj.obj_id] = obj
+
     # ADD ANNOTATION TO A PAGE
 
-    def add_annot_to_page(self,page_no,quad,rect):
-        if self.verbose:
-            print "annotating page",page_no
-        annot = self._create_annotation(rect,quad)
-        self.edited_objs.append(annot)
-        self._add_annot_to_page(page_no,annot)
+    def add_annot_to_page(self,page_no,quad,rect,color=None):
+        '''add a highlight annotation covering <quad> to page <page_no>'''
+        self.add_annots(page_no,[(quad,rect,color)])
 
-    def _add_annot_to_page(self,page_no,annot,overwrite=False):
-        '''add an annotation to a page'''
+    def add_annots(self,page_no,annots):
+        '''add a highlight annotation to page <page_no> for each (quad,rect,color)
+        in <annots>, color may be None or left out for the default.  /Annots is
+        updated once for the whole batch, the page is only copied when the
+        array is held in the page itself'''
+        if len(annots) == 0:
+            return
+        if self.verbose:
+            print "annotating page",page_no,"with",len(annots),"annotations"
+        new_annots = []
+        for annot in annots:
+            quad,rect = annot[0],annot[1]
+            color = None
+            if len(annot) > 2:
+                color = annot[2]
+            new_annot = self._create_annotation(rect,quad,color)
+            self.set_edited_obj(new_annot)
+            new_annots.append(new_annot)
         page = self.get_edited_page(page_no)
-        if page is None:
-            print "first time"
-            page = self.get_page(page_no).edit('copy')
-        else:
-            print "second time"
+        edited = page is not None
+        if not edited:
+            page = self.get_page(page_no)
         cur_value = page.attr('/Annots')
-        if cur_value is not None:
-            if isinstance(cur_value,list):
-                page.attr('/Annots',cur_value.append(annot))
-                self.edited_objs.append(page)
+        if isinstance(cur_value,PDFObject):
+            # the annotations are held in an array object of their own, only
+            # that object has to change
+            annots_obj = self.get_edited_obj(cur_value.obj_id,cur_value.gen_id)
+            if annots_obj is None:
+                annots_obj = self.get_obj(cur_value.obj_id,cur_value.gen_id).edit('copy')
+            if isinstance(annots_obj.value,list):
+                annots_obj.value.extend(new_annots)
+                self.set_edited_obj(annots_obj)
                 return
-            elif isinstance(cur_value,PDFObject):
-                temp = self.get_edited_obj(cur_value.get_obj_id())
-                if temp is not None:
-                    cur_value = temp
-                if cur_value.obj_type == PDF_TYPE_DICT and cur_value.has_attr('/Annot'):
-                    page.attr('/Annots',[cur_value,annot])
-                    self.edited_objs.append(page)
-                    return
-                elif cur_value.obj_type == PDF_TYPE_ARRAY:
-                    new_arr = cur_value.value
-                    new_arr.append(annot.indirect_ref())
-                    cur_value.value = new_arr
-                    self.edited_objs.append(cur_value)
-                    return
-        else:
-            new_arr_obj = self.create_new_arr_obj(values=[annot])
-            self.edited_objs.append(new_arr_obj)
-            page.attr('/Annots',new_arr_obj)
-            self.edited_objs.append(page)
-            return
+            # a lone annotation in place of an array
+            cur_value = [cur_value]
+        elif cur_value is None:
+            cur_value = []
+        if not edited:
+            page = page.edit('copy')
+        page.attr('/Annots',cur_value + new_annots)
+        self.set_edited_obj(page)
+
+    def add_document_annots(self,page_annots):
+        '''add highlight annotations across the document, <page_annots> is a
+        dictionary of {page_no:[(quad,rect,color),...]}, see add_annots'''
+        for page_no in sorted(page_annots):
+            self.add_annots(page_no,page_annots[page_no])
 
     # OBJECT CREATION METHODS 
 
@@ -458,97 +1049,388 @@ class PDF:
         if obj_id is None:
             obj_id = self.get_next_obj_id()
         try:
-            obj_id = str(obj_id)
-        except:
-            raise PDFOperationError("Invalid object id provided: " + obj_id)
-        gen_id = self.get_next_gen_id()
-        arr_obj = str(obj_id) + " " + str(gen_id) + " obj\n[ "
-        for i in values:
-            if isinstance(i,PDFObject):
-                arr_obj += str(i.indirect_ref()) + " "
-            else:
-                arr_obj += py_obj_to_pdf_obj(i,PDFObject) + " "    
-        arr_obj += "]\nendobj"
-        new_arr_obj = PDFObject(self,arr_obj,register=True)
-        return new_arr_obj 
+            obj_id = int(obj_id)
+        except (TypeError,ValueError):
+            raise PDFOperationError("Invalid object id provided: " + str(obj_id))
+        return PDFObject.from_value(self,obj_id,0,list(values),register=True) 
 
 
-    # Notes: May want to expand this to accept all parameters for annotations
     def _create_annotation(self,rect,quad,color=None,obj_id=None):
-        '''Create a new annotation object'''
+        '''Create a new highlight annotation object'''
         if obj_id is None:
             obj_id = self.get_next_obj_id()
-        gen_id = self.get_next_gen_id()
         if color is None or len(color) < 3:
             # Default 'Highlighter Yellow'
             color = [ 0.9686242, 0.8626859, 0.03784475 ]
-        annot = str(obj_id) + " " + str(gen_id) + " obj\n<< /Type/Annot\n/Rect[ "
-        annot += ' '.join(str(i) for i in rect)
-        annot += " ]\n/F 4\n/C[ "
-        annot += ' '.join(str(i) for i in color)
-        annot += " ]\n/QuadPoints[ "
-        annot += ' '.join(str(i) for i in quad)
-        annot += " ]\n/Subtype /Highlight >>\nendobj"
-        annot_obj = PDFObject(self,annot,register=True)
-        return annot_obj 
+        annot = {
+            '/Type':'/Annot',
+            '/Subtype':'/Highlight',
+            '/Rect':list(rect),
+            '/QuadPoints':list(quad),
+            '/C':list(color),
+            '/F':4
+            }
+        return PDFObject.from_value(self,obj_id,0,annot,register=True)
     
     # Note: May want to have a decode_page method,
     #       and call for each page here instead 
     def decode_pdf(self):
         '''decode entire document into plain text'''
-        for i in self.obj_ref:
-            if self.obj_ref[i].obj_type == pdf_utils.PDF_TYPE_STREAM:
-                pass
+        return u'\n'.join(run.text for page_no,run in self.iter_text())
+
+    def iter_text(self,pages=None):
+        '''yield (page_no,text_run) for each run of text in the document, or on
+        the page numbers in <pages>.  The content of a page is only decoded when
+        it is reached, and in lazy documents the page and its content streams
+        are let go once its runs have been yielded, so memory use does not grow
+        with the length of the document'''
+        if pages is None:
+            pages = xrange(1,self.get_page_count()+1)
+        for page_no in pages:
+            page = self.get_page(page_no)
+            try:
+                for run in self.text_interpreter.iter_page_runs(page):
+                    yield page_no,run
+            finally:
+                if self.lazy:
+                    for obj in self._get_content_objs(page):
+                        self._release_obj(obj)
+                    self._release_obj(page)
+
+    def _get_content_objs(self,page):
+        '''return the PDFObjects holding the /Contents of <page>'''
+        contents = page.attr('/Contents')
+        objs = []
+        if isinstance(contents,PDFObject):
+            objs.append(contents)
+            contents = contents.value
+        if isinstance(contents,list):
+            for item in contents:
+                try:
+                    if not isinstance(item,PDFObject):
+                        item = self.get_obj(item)
+                    objs.append(item)
+                except PDFOperationError:
+                    pass
+        return objs
+
+    def _release_obj(self,obj):
+        '''drop an unedited object read from the file, it is read again from its
+        offset the next time it is needed'''
+        if obj._content is None and self._is_xref_obj(obj) and self.obj_ref.get(obj.obj_id) is obj:
+            del(self.obj_ref[obj.obj_id])
+
+    def get_text_index(self,page_no):
+        '''return the PDFPageText of page <page_no>, it is built the first time
+        it is asked for and kept for later searches'''
+        index = self.text_index.get(page_no)
+        if index is None:
+            index = PDFPageText(run for i,run in self.iter_text([page_no]))
+            self.text_index[page_no] = index
+        return index
+
+    def search(self,pattern,flags=0,pages=None):
+        '''find the regular expression <pattern> in the text of the document, or
+        of the page numbers in <pages>.  Returns a list of (page_no,text,quads)
+        for each match, where quads holds a (quad,rect) pair for each line the
+        match covers.  The text of each page is only read once, however many
+        searches are run'''
+        if isinstance(pattern,basestring):
+            pattern = re.compile(pattern,flags|re.UNICODE)
+        if pages is None:
+            pages = xrange(1,self.get_page_count()+1)
+        results = []
+        for page_no in pages:
+            index = self.get_text_index(page_no)
+            for match in pattern.finditer(index.text):
+                quads = index.get_quads(match.start(),match.end())
+                if len(quads) > 0:
+                    results.append((page_no,match.group(),quads))
+        return results
+
+    def highlight(self,pattern,flags=0,pages=None,color=None):
+        '''add a highlight annotation over each match of <pattern>, see search.
+        The annotations for a page are added to it in one batch, returns the
+        number of matches highlighted'''
+        page_annots = {}
+        matches = self.search(pattern,flags,pages)
+        for page_no,text,quads in matches:
+            for quad,rect in quads:
+                page_annots.setdefault(page_no,[]).append((quad,rect,color))
+        self.add_document_annots(page_annots)
+        return len(matches)
 
     # Note: - May want to structure this in a format that is navigable
     #         - get_document_text, by paragraph?, by aribitrarily sized string length?
+    def get_page_runs(self,page_no):
+        '''return the PDFTextRuns of page <page_no>, each holding a string shown
+        on the page along with the box of every character in it'''
+        return list(self.text_interpreter.iter_page_runs(self.get_page(page_no)))
+
     def get_page_text(self,page_no):
-        '''Get Text content from a single page'''
-        page_id = self.get_page_obj_id(page_no)
-        page = self.get_obj(page_id)
-        contents = page.attr('/Contents')
-        groups = re.findall(r'BT.*?ET',contents.attr('stream_decoded'),re.S)
-        groups_text = [''.join(i for i in re.findall(r'\((.*?)\)',x)) for x in groups ]
-        page_text  = groups_text
-        print len(groups)
-        return page_text
-
-    def _apply_edits(self):
-        '''apply unsaved changes to the docuemnt'''
-        new_meta = self.meta.info.edit('/ModDate',get_pdf_date())
-        self.edited_objs.append(new_meta)
-        xref = "xref\n0 1\n0000000000 65535 f\n"
-        print len(self.edited_objs),"edits to make"
-        for i,edit in enumerate(self.edited_objs):
-            print i, edit.value, edit.obj_id
-            for item in edit.value:
-                print item
-            xref += str(edit.obj_id) + " 1\n"
-            xref += str(format_pos_number(len(self.content))) + " " + str(format_gen_number(self.get_next_gen_id())) + " n\n"
-            self.content += edit.to_pdf_obj() + "\n"
-        lastxref = re.findall(r'startxref\s+(\d+)',self.content)
-        lastxref = lastxref[-1]
-        new_trailer = self.trailer.edit('/Prev',int(lastxref))
-        new_trailer.attr('/Size',self.get_next_obj_id(False)-1)
-        xref += new_trailer.to_pdf_obj()
-        xref += "\nstartxref\n"
-        xref += str(len(self.content)+5) + "\n%%EOF"
-        self.content += xref
-        self.next_gen_id += 1
+        '''Get Text content from a single page, a string for each run of text'''
+        return [run.text for run in self.get_page_runs(page_no)]
+
+    def _apply_edits(self,f,compress_level=None):
+        '''append unsaved changes to the open file <f> as an incremental update,
+        only the edited objects, an xref section for them and a trailer pointing
+        back to the previous xref are written'''
+        if isinstance(self.meta.info,PDFObject):
+            self.set_edited_obj(self.meta.info.edit('/ModDate',get_pdf_date()))
+        f.seek(0,2)
+        pos = f.tell()
+        if pos > 0:
+            f.seek(-1,2)
+            if f.read(1) not in "\r\n":
+                f.seek(0,2)
+                f.write("\n")
+                pos += 1
+        f.seek(0,2)
+        entries = {}
+        for edit in self.edited_objs.itervalues():
+            data = self._format_obj(edit.obj_id,edit.gen_id,self._get_write_value(edit.value,compress_level)) + "\n"
+            f.write(data)
+            entries[edit.obj_id] = (pos,edit.gen_id)
+            pos += len(data)
+        if self.verbose or self.debug: print len(self.edited_objs),"edits written"
+        if self.startxref is None:
+            # the previous xref could not be read, so this one has to list every
+            # object, members of object streams are written out again as a plain
+            # xref section cannot point into a stream
+            for obj_id in self.xref:
+                offset,gen_id,stream_id = self.xref[obj_id]
+                if obj_id in entries:
+                    continue
+                elif stream_id is None:
+                    entries[obj_id] = (offset,gen_id)
+                else:
+                    obj = self.get_obj(obj_id,gen_id)
+                    if obj is None:
+                        continue
+                    data = self._format_obj(obj_id,gen_id,self._get_write_value(obj.value,compress_level)) + "\n"
+                    f.write(data)
+                    entries[obj_id] = (pos,gen_id)
+                    pos += len(data)
+        trailer = self._get_trailer_value()
+        trailer['/Size'] = max(resolve_pdf_value(self.trailer.value.get('/Size',0)),self.next_obj_id,max([0] + entries.keys()) + 1)
+        if self.startxref is not None:
+            trailer['/Prev'] = self.startxref
+        f.write(format_xref_section(entries))
+        f.write("trailer\n" + py_obj_to_pdf_obj(trailer) + "\nstartxref\n" + str(pos) + "\n%%EOF\n")
+        self.startxref = pos
+        self.edited_objs.clear()
+
+    def _get_trailer_value(self):
+        '''return a copy of the trailer dictionary without the keys that only
+        belong to a cross-reference stream'''
+        trailer = {}
+        for key in self.trailer.value:
+            if key not in PDF_XREF_STREAM_KEYS:
+                trailer[key] = self.trailer.value[key]
+        return trailer
+
+    def _iter_refs(self,value):
+        '''yield (obj_id,gen_id) for each indirect reference held in <value>'''
+        stack = [value]
+        while len(stack) > 0:
+            value = stack.pop()
+            if isinstance(value,PDFObject):
+                if not value.is_trailer:
+                    yield value.obj_id,value.gen_id
+            elif isinstance(value,dict):
+                for key in value:
+                    if key != 'stream' and key != 'stream_decoded':
+                        stack.append(value[key])
+            elif isinstance(value,list):
+                stack.extend(value)
+            elif isinstance(value,PDFRef):
+                yield value.obj_id,value.gen_id
+            elif is_pdf_ref(value):
+                yield parse_obj_key(value)
+
+    def _get_write_value(self,value,compress_level=None):
+        '''return <value> as it is to be written, streams get a /Length matching
+        their data and those without a /Filter are Flate encoded at
+        <compress_level>, unless it is None'''
+        if not isinstance(value,PDFStream):
+            return value
+        value = dict(value)
+        value.pop('stream_decoded',None)
+        if compress_level is not None and not value.get('/Filter'):
+            value['stream'] = zlib.compress(value['stream'],compress_level)
+            value['/Filter'] = '/FlateDecode'
+            value.pop('/DecodeParms',None)
+        value['/Length'] = len(value['stream'])
+        return value
+
+    def _format_obj(self,obj_id,gen_id,value):
+        return str(obj_id) + " " + str(gen_id) + " obj\n" + py_obj_to_pdf_obj(value) + "\nendobj"
+
+    def _write_rewrite(self,f,compress_level=None,object_streams=False):
+        '''write the whole document to the open file <f> as a single revision,
+        holding only the objects reachable from the trailer, with one xref.
+        Objects keep their numbers, unused numbers are listed as free.  With
+        <object_streams> objects other than streams are packed into object
+        streams, and the xref is written as a cross-reference stream'''
+        if isinstance(self.meta.info,PDFObject):
+            self.meta.info.edit('/ModDate',get_pdf_date())
+        header = PDF_HEADER_REGEX.search(self.content,0,1024)
+        if header is not None:
+            data = header.group(0)
+        else:
+            data = "%PDF-1.4"
+        if object_streams and data < "%PDF-1.5":
+            data = "%PDF-1.5"
+        data += "\n%\xe2\xe3\xcf\xd3\n"
+        f.write(data)
+        pos = len(data)
+        # object and cross-reference streams are always compressed
+        pack_level = compress_level
+        if pack_level is None:
+            pack_level = zlib.Z_DEFAULT_COMPRESSION
+        trailer = self._get_trailer_value()
+        entries = {}
+        members = []
+        pending = list(self._iter_refs(trailer))
+        pending.reverse()
+        while len(pending) > 0:
+            obj_id,gen_id = pending.pop()
+            if obj_id in entries:
+                continue
+            try:
+                obj = self.get_obj(obj_id,gen_id)
+            except PDFOperationError:
+                if self.verbose or self.debug: print "dropping reference to missing object",obj_id,gen_id
+                continue
+            try:
+                value = self._get_write_value(obj.value,compress_level)
+            except PDFOperationError:
+                # keep the source of objects that cannot be parsed as it is
+                value = None
+                data = obj.content.strip()
+            else:
+                data = None
+            if data is None and object_streams and obj.gen_id == 0 and not (isinstance(value,dict) and 'stream' in value):
+                entries[obj_id] = (len(members),0,None)
+                members.append((obj_id,py_obj_to_pdf_obj(value)))
+                if len(members) >= PDF_OBJ_STREAM_SIZE:
+                    pos += self._write_obj_stream(f,pos,members,entries,pack_level)
+                    members = []
+            else:
+                if data is None:
+                    data = self._format_obj(obj.obj_id,obj.gen_id,value)
+                data += "\n"
+                f.write(data)
+                entries[obj_id] = (pos,obj.gen_id,None)
+                pos += len(data)
+            refs = list(self._iter_refs(value))
+            refs.reverse()
+            pending.extend(refs)
+        if len(members) > 0:
+            pos += self._write_obj_stream(f,pos,members,entries,pack_level)
+        if object_streams:
+            xref_id = self.get_next_obj_id()
+            entries[xref_id] = (pos,0,None)
+            size = max(entries.keys()) + 1
+            data,widths = format_xref_stream(entries,size)
+            trailer['/Type'] = '/XRef'
+            trailer['/Size'] = size
+            trailer['/W'] = widths
+            trailer['/Filter'] = '/FlateDecode'
+            trailer['stream'] = zlib.compress(data,pack_level)
+            trailer['/Length'] = len(trailer['stream'])
+            f.write(self._format_obj(xref_id,0,trailer) + "\nstartxref\n" + str(pos) + "\n%%EOF\n")
+        else:
+            size = max([0] + entries.keys()) + 1
+            trailer['/Size'] = size
+            f.write(format_xref_table(dict((obj_id,entries[obj_id][:2]) for obj_id in entries),size))
+            f.write("trailer\n" + py_obj_to_pdf_obj(trailer) + "\nstartxref\n" + str(pos) + "\n%%EOF\n")
+        if self.verbose or self.debug: print len(entries),"objects written"
+        self.startxref = pos
+        self.edited_objs.clear()
+
+    def _write_obj_stream(self,f,pos,members,entries,compress_level):
+        '''write an object stream holding <members> at <pos> in <f> and point their
+        entries at it, returns the number of bytes written'''
+        stream_id = self.get_next_obj_id()
+        data,first = format_obj_stream(members)
+        data = zlib.compress(data,compress_level)
+        stream = {'/Type':'/ObjStm','/N':len(members),'/First':first,'/Filter':'/FlateDecode','/Length':len(data),'stream':data}
+        for i,(obj_id,source) in enumerate(members):
+            entries[obj_id] = (i,0,stream_id)
+        data = self._format_obj(stream_id,0,stream) + "\n"
+        f.write(data)
+        entries[stream_id] = (pos,0,None)
+        return len(data)
 
     # SAVE
     
-    def save(self,filename=None):
-        '''save the file to the given filename or the original filename by default'''
+    def save(self,filename=None,mode='append',compress_level=None,object_streams=False):
+        '''save changes to the given filename or the original filename by default.
+        In 'append' mode changes are appended to the file, saving to a new
+        filename first copies the file there.  In 'rewrite' mode the file is
+        written out again with only the objects still in use, and with
+        <object_streams> objects are packed into object streams.  Streams
+        without a filter are Flate encoded at zlib level <compress_level>, unless
+        it is None.  Later saves are made to the new file.  Neither compression
+        nor object streams can be used on encrypted documents, as their strings
+        and streams are written still encrypted'''
         if filename is None:
             filename = self.filename
         filename = assert_pdf_ext(filename)
-        self._apply_edits()
-        with open(filename,'w') as f:
-            f.write(self.content)
+        if (compress_level is not None or object_streams) and '/Encrypt' in self.trailer.value:
+            raise PDFOperationError("compress_level and object_streams cannot be used to save an encrypted document")
+        if mode == 'rewrite':
+            # written to a temporary file in the same directory and renamed over
+            # the target, so the original is never lost part way through
+            fd,temp = tempfile.mkstemp('.pdf',dir=os.path.dirname(os.path.abspath(filename)))
+            try:
+                with os.fdopen(fd,'wb') as f:
+                    self._write_rewrite(f,compress_level,object_streams)
+                if os.path.exists(filename):
+                    shutil.copymode(filename,temp)
+                else:
+                    os.chmod(temp,get_new_file_mode())
+                os.rename(temp,filename)
+            except:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+            self.filename = filename
+            if self.verbose or self.debug:
+                print "Saved file to:",filename
+            return
+        elif mode != 'append':
+            raise PDFOperationError("Unknown save mode '" + str(mode) + "', expected 'append' or 'rewrite'")
+        elif object_streams:
+            raise PDFOperationError("Object streams can only be written when saving with mode='rewrite'")
+        if os.path.abspath(filename) != os.path.abspath(self.filename):
+            with open(self.filename,'rb') as src:
+                with open(filename,'wb') as dst:
+                    shutil.copyfileobj(src,dst)
+            self.filename = filename
+        with open(filename,'r+b') as f:
+            self._apply_edits(f,compress_level)
         if self.verbose or self.debug:
             print "Saved file to:",filename
 
+    def read_into_memory(self):
+        '''replace a memory mapped file with an in-memory copy of its content, for
+        when the PDF is still needed after the file changes, object offsets are
+        unaffected'''
+        if self._map is not None:
+            self.content = self._map[:]
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        '''release the memory map of the file, or the content read from it.  Objects
+        not yet parsed cannot be read afterwards'''
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.content = None
+
     # TO STRING METHODS
     
     def __unicode__(self):
@@ -559,12 +1441,13 @@ class PDF:
             msg += "\n\tFilename:\t\t" + str(self.filename)
             msg += "\n\tNumber of pages:\t" + str(self.get_page_count())
             if self.vv:
-                msg += "\nPage Ref:\n" +str(self.page_ref)
+                msg += "\nPage Tree:\n" +str(self.page_tree)
             msg += "\n\tNumber of Objects:\t" + str(self.get_obj_count())
             if self.vv:
                 msg += "\nObject Ref:\n"+str(self.obj_ref)
             msg += "\n\tNext Object Number:\t" + str(self.get_next_obj_id(False))
             msg += "\n\tNext Generation Number:\t" + str(self.get_next_gen_id())
+            msg += "\n\tStream Cache:\t\t" + str(self.stream_cache.hits) + " hits, " + str(self.stream_cache.misses) + " misses (" + str(round(100*self.stream_cache.hit_rate(),1)) + "% hit rate)"
         else:
             msg = self.__repr__() 
         return msg
@@ -598,45 +1481,77 @@ class PDF:
     def stream_test(self):
         '''Test for decoding streams'''
         streams = []
-        for obj_id in self.obj_ref:
-            if self.obj_ref[obj_id].obj_type == PDF_TYPE_STREAM:
-                streams.append(self.obj_ref[obj_id])
+        for obj in self.iter_objs():
+            if obj.obj_type == PDF_TYPE_STREAM:
+                streams.append(obj)
         for stream in streams:
             edited_stream = stream.edit('stream',stream.attr('stream_decoded'))
             edited_stream.attr('/Filter',remove=True)
-            self.edited_objs.append(edited_stream)
+            self.set_edited_obj(edited_stream)
         self.save('stream_test.pdf')
 
     def text_test(self):
         '''print the text content of every page'''
-        for i in self.get_page_range():
-            print "Page",i
-            print self.get_page_text(i)
+        last_page_no = None
+        for page_no,run in self.iter_text():
+            if page_no != last_page_no:
+                print "Page",page_no
+                last_page_no = page_no
+            print run
 
     def stringify_test(self):
         '''print the to_pdf_obj method of every object'''
-        for obj_id in self.obj_ref:
-            print self.obj_ref[obj_id].to_pdf_obj()
+        for obj in self.iter_objs():
+            print obj.to_pdf_obj()
 
     def annot_test(self):
         '''apply an arbitrary annotation to every page'''
         quad = [ 102.5784, 719.94, 113.9088, 719.94, 102.5784, 705.876, 113.9088, 705.876 ]
         rect = [ 102.5784, 705.876, 113.9088, 719.94 ]
+        annots = [(quad,rect),([j+100 for j in quad],[j+100 for j in rect])]
         for i in range(1,self.get_page_count()+1):
             print "Annotating page",i
-            self.add_annot_to_page(i,quad,rect)
-            quad = [j+100 for j in quad]
-            rect = [j+100 for j in rect]
-            self.add_annot_to_page(i,quad,rect)
-            quad = [ 102.5784, 719.94, 113.9088, 719.94, 102.5784, 705.876, 113.9088, 705.876 ]
-            rect = [ 102.5784, 705.876, 113.9088, 719.94 ]
+            self.add_annots(i,annots)
         self.save('annot_test_output.pdf')
 
+def _decode_stream(job):
+    '''decode one stream for PDF.decode_streams, streams that fail are left to be
+    decoded, and raise, when they are used'''
+    data,filters,parms,max_size = job
+    try:
+        return stream_decode(data,filters,parms,max_size)
+    except Exception:
+        return None
+
+def process_file(job):
+    '''open and index a single file for the command line, <job> is a tuple of
+    (filename,debug,verbose,vv).  Errors are returned rather than raised so that
+    one bad file does not stop a run, the result is a tuple of
+    (filename,size,seconds,pages,objects,error)'''
+    filename,debug,verbose,vv = job
+    start = time.time()
+    try:
+        size = os.path.getsize(filename)
+        pdf = PDF(filename,debug=debug,verbose=verbose,vv=vv)
+        if debug:
+            try:
+                pdf.test()
+            except:
+                print "err"
+        result = (filename,size,time.time()-start,pdf.get_page_count(),pdf.get_obj_count(),None)
+        pdf.close()
+        return result
+    except (PDFFormatError,PDFOperationError) as e:
+        return (filename,0,time.time()-start,0,0,str(e))
+    except Exception as e:
+        return (filename,0,time.time()-start,0,0,e.__class__.__name__ + ": " + str(e))
+
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option("-v","--verbose",dest="verbose",action="store_true",default=False)
     parser.add_option("-V","--very-verbose",dest="vv",action="store_true",default=False)
     parser.add_option("-d","--debug",dest="debug",action="store_true",default=False)
+    parser.add_option("-j","--jobs",dest="jobs",type="int",default=1,help="number of files to process at once")
     (opts,args) = parser.parse_args()
     if opts.debug: print opts
     # input files
@@ -648,12 +1563,25 @@ if __name__ == '__main__':
     else:
         files = tests
 
-    for file in files:
-        pdf = PDF(file,debug=opts.debug,verbose=opts.verbose,vv=opts.vv)
-        if opts.debug:
-            try:
-                pdf.test()
-            except:
-                print "err"
-
-
+    jobs = [(file,opts.debug,opts.verbose,opts.vv) for file in files]
+    start = time.time()
+    pool = None
+    if opts.jobs > 1:
+        pool = Pool(opts.jobs)
+        results = pool.imap_unordered(process_file,jobs)
+    else:
+        results = (process_file(job) for job in jobs)
+    total_size = 0
+    failed = 0
+    for filename,size,elapsed,pages,objects,error in results:
+        if error is None:
+            total_size += size
+            print filename + ":",pages,"pages,",objects,"objects in",round(elapsed,3),"s"
+        else:
+            failed += 1
+            print filename + ": error:",error
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = max(time.time() - start,1e-6)
+    print len(files),"files,",failed,"failed, in",round(elapsed,3),"s:",round(len(files)/elapsed,2),"files/s,",round(total_size/elapsed/1048576,2),"MB/s"
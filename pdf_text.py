@@ -0,0 +1,614 @@
+from pdf_utils import *
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#    Content stream interpreter, runs the operators of a
+#    page tracking the graphics and text state so that each
+#    string shown comes out as a PDFTextRun holding its text
+#    and the box of every character in user space
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+PDF_IDENTITY_MATRIX = (1,0,0,1,0,0)
+
+def mult_matrix(m1,m2):
+    '''return the product <m1> x <m2> of two PDF matrices (a,b,c,d,e,f)'''
+    a1,b1,c1,d1,e1,f1 = m1
+    a2,b2,c2,d2,e2,f2 = m2
+    return (a1*a2+b1*c2,a1*b2+b1*d2,c1*a2+d1*c2,c1*b2+d1*d2,e1*a2+f1*c2+e2,e1*b2+f1*d2+f2)
+
+def translate_matrix(m,tx):
+    '''return (1,0,0,1,tx,0) x <m>, the matrix <m> moved <tx> along its x axis'''
+    return (m[0],m[1],m[2],m[3],m[4]+tx*m[0],m[5]+tx*m[1])
+
+def apply_matrix(m,x,y):
+    return (m[0]*x+m[2]*y+m[4],m[1]*x+m[3]*y+m[5])
+
+PDF_INLINE_IMAGE_END_REGEX = re.compile(r'[\x00\t\n\x0c\r ]EI(?=[\x00\t\n\x0c\r ]|\Z)')
+
+def iter_content_ops(data):
+    '''split the content stream <data>, a string or an iterable of chunks of one,
+    into (operator,operands) pairs, operands are parsed as for objects with
+    strings left as their source.  Inline images come out as
+    ('BI',[parms,image data]).  Chunks are lexed as they arrive, only the
+    operation cut off at the end of the data so far is held over'''
+    if isinstance(data,basestring):
+        data = (data,)
+    chunks = iter(data)
+    buffer = ''
+    wanted = 0
+    final = False
+    while not final:
+        chunk = next(chunks,None)
+        if chunk is None:
+            final = True
+        else:
+            buffer += chunk
+            if len(buffer) < wanted:
+                continue
+        done = 0
+        try:
+            for op,operands,end in _iter_buffer_ops(buffer,final):
+                done = end
+                yield op,operands
+        except PDFFormatError:
+            # an error may only mean the operation is not all here yet
+            if final:
+                raise
+        buffer = buffer[done:]
+        # wait for the held over data to double before lexing it again, so a
+        # long operation is not lexed again for every chunk
+        wanted = 2*len(buffer)
+
+def _iter_buffer_ops(data,final):
+    '''yield (operator,operands,end) for the operations in <data> that are
+    complete, those running up to the end of <data> are not unless it is
+    <final>'''
+    parser = PDFParser(data)
+    lexer = parser.lexer
+    operands = []
+    while True:
+        token = lexer.next_token()
+        if token is None:
+            return
+        token_type,value,start = token
+        if token_type == TOKEN_KEYWORD and value not in ('true','false','null'):
+            if value == 'BI':
+                operands = _read_inline_image(parser,start)
+            if not final and lexer.pos >= len(data):
+                return
+            yield value,operands,lexer.pos
+            operands = []
+        else:
+            operands.append(parser.parse_value(token))
+
+def _read_inline_image(parser,start):
+    lexer = parser.lexer
+    parms = {}
+    while True:
+        token = lexer.next_token()
+        if token is None:
+            raise PDFFormatError("Inline image at offset " + str(start) + " is not terminated")
+        if token[0] == TOKEN_KEYWORD and token[1] == 'ID':
+            break
+        if token[0] != TOKEN_NAME:
+            raise PDFFormatError("Inline image key at offset " + str(token[2]) + " is not a name")
+        parms[token[1]] = parser.parse_value()
+    pos = lexer.pos + 1
+    end = PDF_INLINE_IMAGE_END_REGEX.search(parser.data,pos)
+    if end is None:
+        raise PDFFormatError("Inline image at offset " + str(start) + " is not terminated")
+    lexer.pos = end.end()
+    return [parms,parser.data[pos:end.start()]]
+
+def parse_to_unicode(data):
+    '''read the bfchar and bfrange mappings of a /ToUnicode CMap into a dictionary
+    of character codes to unicode text'''
+    cmap = {}
+    parser = PDFParser(data)
+    values = []
+    while True:
+        token = parser.lexer.next_token()
+        if token is None:
+            break
+        if token[0] != TOKEN_KEYWORD:
+            values.append(parser.parse_value(token))
+            continue
+        if token[1] == 'endbfchar':
+            for i in range(0,len(values)-1,2):
+                if isinstance(values[i],basestring) and isinstance(values[i+1],basestring):
+                    cmap[_cmap_code(values[i])] = _cmap_text(decode_pdf_string(values[i+1]))
+        elif token[1] == 'endbfrange':
+            for i in range(0,len(values)-2,3):
+                low,high,dst = values[i:i+3]
+                if not isinstance(low,basestring) or not isinstance(high,basestring):
+                    continue
+                low = _cmap_code(low)
+                high = min(_cmap_code(high),low+0xffff)
+                if isinstance(dst,list):
+                    for code,text in zip(range(low,high+1),dst):
+                        if isinstance(text,basestring):
+                            cmap[code] = _cmap_text(decode_pdf_string(text))
+                elif isinstance(dst,basestring):
+                    dst = decode_pdf_string(dst)
+                    first = int(binascii.hexlify(dst) or '0',16)
+                    for code in range(low,high+1):
+                        text = '%0*x' % (2*len(dst),first+code-low)
+                        cmap[code] = _cmap_text(binascii.unhexlify(text[-2*len(dst):]))
+        values = []
+    return cmap
+
+def _cmap_code(value):
+    return int(binascii.hexlify(decode_pdf_string(value)) or '0',16)
+
+def _cmap_text(data):
+    return data.decode('utf-16-be','replace')
+
+# Unicode for glyph names that are not single characters or uniXXXX names,
+# as found in /Differences arrays
+PDF_GLYPH_NAMES = {
+    'space':u' ','exclam':u'!','quotedbl':u'"','numbersign':u'#','dollar':u'$',
+    'percent':u'%','ampersand':u'&','quotesingle':u"'",'parenleft':u'(',
+    'parenright':u')','asterisk':u'*','plus':u'+','comma':u',','hyphen':u'-',
+    'period':u'.','slash':u'/','zero':u'0','one':u'1','two':u'2','three':u'3',
+    'four':u'4','five':u'5','six':u'6','seven':u'7','eight':u'8','nine':u'9',
+    'colon':u':','semicolon':u';','less':u'<','equal':u'=','greater':u'>',
+    'question':u'?','at':u'@','bracketleft':u'[','backslash':u'\\',
+    'bracketright':u']','asciicircum':u'^','underscore':u'_','grave':u'`',
+    'braceleft':u'{','bar':u'|','braceright':u'}','asciitilde':u'~',
+    'quoteleft':u'\u2018','quoteright':u'\u2019','quotedblleft':u'\u201c',
+    'quotedblright':u'\u201d','endash':u'\u2013','emdash':u'\u2014',
+    'bullet':u'\u2022','ellipsis':u'\u2026','fi':u'fi','fl':u'fl','ff':u'ff',
+    'ffi':u'ffi','ffl':u'ffl',
+}
+
+def glyph_name_to_unicode(name):
+    '''return the text for the glyph <name>, or None when it is not known'''
+    name = name.lstrip('/').split('.')[0]
+    if name in PDF_GLYPH_NAMES:
+        return PDF_GLYPH_NAMES[name]
+    elif len(name) == 1:
+        return unicode(name)
+    try:
+        if name.startswith('uni') and len(name) >= 7 and len(name) % 4 == 3:
+            return binascii.unhexlify(name[3:]).decode('utf-16-be')
+        elif name.startswith('u') and 5 <= len(name) <= 7:
+            return unichr(int(name[1:],16))
+    except (TypeError,ValueError):
+        pass
+    return None
+
+# Widths of the standard fonts, which files may use without /Widths.  Helvetica
+# is given for codes 32 to 126 and stands in for its bold and oblique forms
+PDF_HELVETICA_WIDTHS = [
+    278,278,355,556,556,889,667,191,333,333,389,584,278,333,278,278,
+    556,556,556,556,556,556,556,556,556,556,278,278,584,584,584,556,
+    1015,667,667,722,722,667,611,778,722,278,500,667,556,833,722,778,
+    667,778,722,667,611,722,667,944,667,667,611,278,278,278,469,556,
+    333,556,556,500,556,556,278,556,556,222,222,500,222,833,556,556,
+    556,556,333,500,278,556,500,722,500,500,500,334,260,334,584,
+]
+PDF_COURIER_WIDTH = 600
+PDF_DEFAULT_WIDTH = 500
+
+# Adjustments in TJ arrays that move further right than this, in thousandths of
+# an em, are read as word spaces
+PDF_TJ_SPACE = 200
+
+class PDFFont(object):
+    '''the widths and character mapping of a font resource, enough to place and
+    read the text shown in it.  <font> is the font dictionary and <resolve>
+    follows references in it'''
+    def __init__(self,font,resolve):
+        self.widths = {}
+        self.default_width = PDF_DEFAULT_WIDTH
+        self.ascent = 800
+        self.descent = -200
+        self.is_cid = font.get('/Subtype') == '/Type0'
+        self.encoding = {}
+        self.codec = 'cp1252'
+        self.cmap = {}
+        descriptor = None
+        if self.is_cid:
+            descendants = resolve(font.get('/DescendantFonts'))
+            if isinstance(descendants,list) and len(descendants) > 0:
+                cid_font = resolve(descendants[0])
+                if isinstance(cid_font,dict):
+                    self.default_width = resolve(cid_font.get('/DW',1000))
+                    self._read_cid_widths(resolve(cid_font.get('/W')),resolve)
+                    descriptor = resolve(cid_font.get('/FontDescriptor'))
+        else:
+            widths = resolve(font.get('/Widths'))
+            if isinstance(widths,list):
+                first = resolve(font.get('/FirstChar',0))
+                for i,width in enumerate(widths):
+                    self.widths[first+i] = resolve(width)
+            else:
+                self._read_standard_widths(resolve(font.get('/BaseFont','')))
+            self._read_encoding(resolve(font.get('/Encoding')),resolve)
+            descriptor = resolve(font.get('/FontDescriptor'))
+        if isinstance(descriptor,dict):
+            if not self.is_cid and '/MissingWidth' in descriptor:
+                self.default_width = resolve(descriptor['/MissingWidth'])
+            self.ascent = resolve(descriptor.get('/Ascent',self.ascent)) or self.ascent
+            self.descent = resolve(descriptor.get('/Descent',self.descent))
+        to_unicode = resolve(font.get('/ToUnicode'))
+        if isinstance(to_unicode,PDFStream):
+            try:
+                self.cmap = parse_to_unicode(to_unicode['stream_decoded'])
+            except (PDFFormatError,PDFOperationError):
+                pass
+
+    def _read_cid_widths(self,widths,resolve):
+        '''read a /W array, made up of 'first [w1 w2 ...]' and 'first last w'
+        entries'''
+        if not isinstance(widths,list):
+            return
+        i = 0
+        while i+1 < len(widths):
+            first = resolve(widths[i])
+            item = resolve(widths[i+1])
+            if isinstance(item,list):
+                for j,width in enumerate(item):
+                    self.widths[first+j] = resolve(width)
+                i += 2
+            elif i+2 < len(widths):
+                for code in xrange(first,min(item,first+0xffff)+1):
+                    self.widths[code] = resolve(widths[i+2])
+                i += 3
+            else:
+                break
+
+    def _read_standard_widths(self,base_font):
+        name = base_font.lstrip('/').split('+')[-1]
+        if name.startswith('Courier'):
+            self.default_width = PDF_COURIER_WIDTH
+        elif name.startswith('Helvetica') or name.startswith('Arial'):
+            for i,width in enumerate(PDF_HELVETICA_WIDTHS):
+                self.widths[32+i] = width
+
+    def _read_encoding(self,encoding,resolve):
+        if isinstance(encoding,dict):
+            differences = resolve(encoding.get('/Differences'))
+            encoding = encoding.get('/BaseEncoding')
+            if isinstance(differences,list):
+                code = 0
+                for item in differences:
+                    item = resolve(item)
+                    if isinstance(item,(int,long)):
+                        code = item
+                    elif isinstance(item,basestring):
+                        text = glyph_name_to_unicode(item)
+                        if text is not None:
+                            self.encoding[code] = text
+                        code += 1
+        if encoding == '/MacRomanEncoding':
+            self.codec = 'mac_roman'
+
+    def get_codes(self,data):
+        '''split the bytes of a shown string into character codes, two bytes
+        each for composite fonts'''
+        if self.is_cid:
+            return [(ord(data[i]) << 8) | ord(data[i+1]) for i in xrange(0,len(data)-1,2)]
+        return [ord(c) for c in data]
+
+    def get_width(self,code):
+        '''return the width of <code> in thousandths of an em'''
+        return self.widths.get(code,self.default_width)
+
+    def get_text(self,code):
+        '''return the unicode text of <code>'''
+        text = self.cmap.get(code)
+        if text is not None:
+            return text
+        if self.is_cid:
+            return u'\ufffd'
+        text = self.encoding.get(code)
+        if text is not None:
+            return text
+        return chr(code).decode(self.codec,'replace')
+
+class PDFTextRun(object):
+    '''the text shown by one text operator.  <boxes> holds the box of each
+    character of <text> in user space as (x0,y0,x1,y1), <font> is the name of
+    the font resource and <size> the font size'''
+    __slots__ = ('text','boxes','font','size')
+
+    def __init__(self,text,boxes,font=None,size=0):
+        self.text = text
+        self.boxes = boxes
+        self.font = font
+        self.size = size
+
+    def get_bbox(self,start=0,end=None):
+        '''return the box around the characters from <start> to <end>'''
+        boxes = self.boxes[start:end]
+        if len(boxes) == 0:
+            return None
+        return (min(b[0] for b in boxes),min(b[1] for b in boxes),max(b[2] for b in boxes),max(b[3] for b in boxes))
+
+    def __unicode__(self):
+        return self.text
+
+    def __str__(self):
+        return self.text.encode('utf-8')
+
+    def __repr__(self):
+        return "<PDFTextRun " + repr(self.text) + " at " + str(self.get_bbox()) + " >"
+
+# Form XObjects drawn inside each other deeper than this are not followed
+PDF_MAX_FORM_DEPTH = 12
+
+class PDFTextInterpreter(object):
+    '''runs the content streams of pages in <pdf>, tracking the graphics state
+    (q, Q, cm) and the text state (Tm, Td, TD, T*, Tf, Tc, Tw, Tz, TL, Ts) to
+    yield a PDFTextRun for each string shown.  Fonts are read once and kept for
+    the pages that follow'''
+    def __init__(self,pdf):
+        self.pdf = pdf
+        self.fonts = {}
+        self.default_font = PDFFont({},self.resolve)
+
+    def resolve(self,value):
+        '''follow a reference or a link to a PDFObject through to its value'''
+        if is_pdf_ref(value):
+            try:
+                value = self.pdf.get_obj(value)
+            except PDFOperationError:
+                return None
+        return resolve_pdf_value(value)
+
+    def get_page_resources(self,page):
+        '''return the /Resources of <page>, which it may inherit from the /Pages
+        nodes above it'''
+        node = page
+        for i in range(PDF_MAX_NESTING):
+            value = self.resolve(node)
+            if not isinstance(value,dict):
+                break
+            resources = self.resolve(value.get('/Resources'))
+            if isinstance(resources,dict):
+                return resources
+            node = value.get('/Parent')
+            if node is None:
+                break
+        return {}
+
+    def iter_content_data(self,contents):
+        '''yield the decoded data of a /Contents stream, or of an array of them
+        joined together, a chunk at a time'''
+        contents = self.resolve(contents)
+        if not isinstance(contents,list):
+            contents = [contents]
+        for i,stream in enumerate(contents):
+            stream = self.resolve(stream)
+            if not isinstance(stream,PDFStream):
+                continue
+            if i > 0:
+                yield '\n'
+            try:
+                for chunk in stream.iter_decoded():
+                    yield chunk
+            except PDFOperationError as e:
+                if self.pdf.verbose or self.pdf.debug: print "Warning: content stream could not be decoded:",e
+
+    def iter_page_runs(self,page):
+        '''yield the PDFTextRuns of the PDFObject <page> in the order they are
+        drawn'''
+        data = self.iter_content_data(page.attr('/Contents'))
+        return self.iter_runs(data,self.get_page_resources(page))
+
+    def get_font(self,resources,name):
+        fonts = self.resolve(resources.get('/Font'))
+        if not isinstance(fonts,dict):
+            return self.default_font
+        ref = fonts.get(name)
+        if isinstance(ref,PDFRef):
+            key = ref.obj_id
+        elif is_pdf_ref(ref):
+            key = parse_obj_key(ref)[0]
+        elif hasattr(ref,'indirect_ref'):
+            key = ref.obj_id
+        else:
+            key = None
+        font = self.fonts.get(key)
+        if font is None:
+            value = self.resolve(ref)
+            if not isinstance(value,dict):
+                return self.default_font
+            font = PDFFont(value,self.resolve)
+            if key is not None:
+                self.fonts[key] = font
+        return font
+
+    def iter_runs(self,data,resources,ctm=PDF_IDENTITY_MATRIX,depth=0):
+        '''yield the PDFTextRuns of the content stream <data> drawn with
+        <resources> under the transformation <ctm>'''
+        state = {'ctm':ctm,'font':self.default_font,'font_name':None,'size':0,'Tc':0,'Tw':0,'Tz':100,'TL':0,'Ts':0}
+        stack = []
+        tm = tlm = PDF_IDENTITY_MATRIX
+        ops = iter_content_ops(data)
+        while True:
+            try:
+                op,operands = next(ops)
+            except StopIteration:
+                return
+            except PDFFormatError as e:
+                if self.pdf.verbose or self.pdf.debug: print "Warning: content stream is damaged, text after it is skipped:",e
+                return
+            try:
+                if op == 'q':
+                    stack.append(dict(state))
+                elif op == 'Q':
+                    if len(stack) > 0:
+                        state = stack.pop()
+                elif op == 'cm':
+                    state['ctm'] = mult_matrix(tuple(operands[-6:]),state['ctm'])
+                elif op == 'BT':
+                    tm = tlm = PDF_IDENTITY_MATRIX
+                elif op == 'Tf':
+                    state['font_name'] = operands[-2]
+                    state['font'] = self.get_font(resources,operands[-2])
+                    state['size'] = operands[-1]
+                elif op in ('Tc','Tw','Tz','TL','Ts'):
+                    state[op] = operands[-1]
+                elif op == 'Td' or op == 'TD':
+                    if op == 'TD':
+                        state['TL'] = -operands[-1]
+                    tm = tlm = mult_matrix((1,0,0,1,operands[-2],operands[-1]),tlm)
+                elif op == 'Tm':
+                    tm = tlm = tuple(operands[-6:])
+                elif op == 'T*':
+                    tm = tlm = mult_matrix((1,0,0,1,0,-state['TL']),tlm)
+                elif op == 'Tj' or op == 'TJ' or op == "'" or op == '"':
+                    if op == "'" or op == '"':
+                        if op == '"':
+                            state['Tw'],state['Tc'] = operands[-3],operands[-2]
+                        tm = tlm = mult_matrix((1,0,0,1,0,-state['TL']),tlm)
+                    items = operands[-1]
+                    if not isinstance(items,list):
+                        items = [items]
+                    run,tm = self._show(state,tm,items)
+                    if run is not None:
+                        yield run
+                elif op == 'Do' and depth < PDF_MAX_FORM_DEPTH:
+                    for run in self._iter_form_runs(state,resources,operands[-1],depth):
+                        yield run
+            except (IndexError,TypeError,ValueError,KeyError):
+                # operators with missing or mistyped operands are skipped
+                continue
+
+    def _iter_form_runs(self,state,resources,name,depth):
+        xobjects = self.resolve(resources.get('/XObject'))
+        if not isinstance(xobjects,dict):
+            return []
+        form = self.resolve(xobjects.get(name))
+        if not isinstance(form,PDFStream) or form.get('/Subtype') != '/Form':
+            return []
+        matrix = self.resolve(form.get('/Matrix'))
+        if not isinstance(matrix,list) or len(matrix) != 6:
+            matrix = PDF_IDENTITY_MATRIX
+        form_resources = self.resolve(form.get('/Resources'))
+        if not isinstance(form_resources,dict):
+            form_resources = resources
+        data = self.iter_content_data(form)
+        return self.iter_runs(data,form_resources,mult_matrix(tuple(matrix),state['ctm']),depth+1)
+
+    def _show(self,state,tm,items):
+        '''place the strings and TJ adjustments in <items>, returns the run and
+        the text matrix after it'''
+        font = state['font']
+        size = state['size']
+        scale = state['Tz']/100.
+        rise = state['Ts']
+        ctm = state['ctm']
+        bottom = rise + font.descent*size/1000.
+        top = rise + font.ascent*size/1000.
+        # the text matrix and its product with the ctm are moved along together
+        trm = mult_matrix(tm,ctm)
+        text = []
+        boxes = []
+        for item in items:
+            if isinstance(item,(int,long,float)):
+                tx = -item/1000.*size*scale
+                if -item > PDF_TJ_SPACE and len(text) > 0 and not text[-1].isspace():
+                    text.append(u' ')
+                    boxes.append(self._get_box(trm,tx,bottom,top))
+                tm = translate_matrix(tm,tx)
+                trm = translate_matrix(trm,tx)
+                continue
+            if not isinstance(item,basestring):
+                continue
+            data = decode_pdf_string(item)
+            for code in font.get_codes(data):
+                tx = font.get_width(code)/1000.*size
+                box = self._get_box(trm,tx*scale,bottom,top)
+                for char in font.get_text(code):
+                    text.append(char)
+                    boxes.append(box)
+                tx += state['Tc']
+                if code == 32 and not font.is_cid:
+                    tx += state['Tw']
+                tm = translate_matrix(tm,tx*scale)
+                trm = translate_matrix(trm,tx*scale)
+        if len(text) == 0:
+            return None,tm
+        return PDFTextRun(u''.join(text),boxes,state['font_name'],size),tm
+
+    def _get_box(self,m,width,bottom,top):
+        '''return the box in user space of a glyph <width> wide between <bottom>
+        and <top> in text space, under the matrix <m>'''
+        a,b,c,d,e,f = m
+        if b == 0 and c == 0:
+            x0,x1 = sorted((e,e+a*width))
+            y0,y1 = sorted((f+d*bottom,f+d*top))
+            return (x0,y0,x1,y1)
+        points = [apply_matrix(m,x,y) for x in (0,width) for y in (bottom,top)]
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        return (min(xs),min(ys),max(xs),max(ys))
+
+def get_run_separator(last,run):
+    '''return the text that goes between <last> and the <run> drawn after it,
+    nothing when the run carries on the same word, a space when it carries on
+    the same line and a newline when it starts a new one'''
+    a = last.boxes[-1]
+    b = run.boxes[0]
+    height = max(a[3]-a[1],b[3]-b[1])
+    if abs((a[1]+a[3]) - (b[1]+b[3]))/2. > height/2. or b[0] < a[0] - height:
+        return u'\n'
+    if b[0] - a[2] > height*PDF_WORD_GAP and not last.text[-1].isspace() and not run.text[0].isspace():
+        return u' '
+    return u''
+
+# Gaps between runs on a line wider than this, as a fraction of the height of
+# the text, are read as word spaces
+PDF_WORD_GAP = 0.15
+
+class PDFPageText(object):
+    '''the text of a page as a single string built from its <runs>, along with
+    the box of each character so that matches found in the text can be placed
+    on the page.  Characters added between runs have no box'''
+    __slots__ = ('text','boxes')
+
+    def __init__(self,runs):
+        parts = []
+        boxes = []
+        last = None
+        for run in runs:
+            if last is not None:
+                separator = get_run_separator(last,run)
+                parts.append(separator)
+                boxes.extend([None]*len(separator))
+            parts.append(run.text)
+            boxes.extend(run.boxes)
+            last = run
+        self.text = u''.join(parts)
+        self.boxes = boxes
+
+    def get_quads(self,start,end):
+        '''return a (quad,rect) pair covering each line of the characters from
+        <start> to <end>, quads run top left, top right, bottom left, bottom
+        right as annotations expect'''
+        quads = []
+        line = None
+        for i in xrange(start,end):
+            box = self.boxes[i]
+            if box is None:
+                if self.text[i] == u'\n' and line is not None:
+                    quads.append(_line_quad(line))
+                    line = None
+                continue
+            if line is not None and line[1] <= (box[1]+box[3])/2. <= line[3] and box[0] >= line[0]:
+                line = [line[0],min(line[1],box[1]),max(line[2],box[2]),max(line[3],box[3])]
+            else:
+                if line is not None:
+                    quads.append(_line_quad(line))
+                line = list(box)
+        if line is not None:
+            quads.append(_line_quad(line))
+        return quads
+
+def _line_quad(box):
+    x0,y0,x1,y1 = box
+    return [x0,y1,x1,y1,x0,y0,x1,y0],[x0,y0,x1,y1]
@@ -1,7 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import re
 import zlib
+import binascii
+import itertools
+from array import array
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class PDFFormatError(Exception):
     pass
@@ -22,6 +32,30 @@ PDF_TYPE_NAME = 8
 
 PDF_DELIMETERS = ['{','}','(',')','<','>','[',']','{','}','/','%']
 
+def py_obj_to_pdf_type(py_obj):
+    '''return the PDF type that the python value <py_obj> is written as'''
+    if isinstance(py_obj,dict):
+        if 'stream' in py_obj:
+            return PDF_TYPE_STREAM
+        return PDF_TYPE_DICT
+    elif isinstance(py_obj,list):
+        return PDF_TYPE_ARRAY
+    elif py_obj is None:
+        return PDF_TYPE_NULL
+    elif isinstance(py_obj,bool):
+        return PDF_TYPE_BOOL
+    elif isinstance(py_obj,(int,float,long)):
+        return PDF_TYPE_NUM
+    elif isinstance(py_obj,basestring):
+        if is_pdf_ref(py_obj):
+            return PDF_TYPE_REF
+        elif py_obj.startswith('/'):
+            return PDF_TYPE_NAME
+        return PDF_TYPE_STRING
+    elif hasattr(py_obj,'indirect_ref'):
+        return PDF_TYPE_REF
+    return PDF_TYPE_INVALID
+
 def pdf_type_to_str(obj_type):
     types = {
         0 : 'Reference',
@@ -39,6 +73,315 @@ def pdf_type_to_str(obj_type):
     except:
         return "TYPE NOT FOUND"
 
+# Lexer token types
+TOKEN_NAME = 0
+TOKEN_NUMBER = 1
+TOKEN_STRING = 2
+TOKEN_HEXSTRING = 3
+TOKEN_ARRAY_START = 4
+TOKEN_ARRAY_END = 5
+TOKEN_DICT_START = 6
+TOKEN_DICT_END = 7
+TOKEN_REF = 8
+TOKEN_STREAM = 9
+TOKEN_KEYWORD = 10
+
+PDF_SKIP_REGEX = re.compile(r'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*')
+PDF_REF_TOKEN_REGEX = re.compile(r'(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R(?=[\x00\t\n\x0c\r ()<>\[\]{}/%]|\Z)')
+PDF_NUMBER_TOKEN_REGEX = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?=[\x00\t\n\x0c\r ()<>\[\]{}/%]|\Z)')
+PDF_NAME_TOKEN_REGEX = re.compile(r'/[^\x00\t\n\x0c\r ()<>\[\]{}/%]*')
+PDF_KEYWORD_TOKEN_REGEX = re.compile(r'[^\x00\t\n\x0c\r ()<>\[\]{}/%]+')
+PDF_HEXSTRING_TOKEN_REGEX = re.compile(r'<[0-9A-Fa-f\x00\t\n\x0c\r ]*>')
+PDF_STRING_SPECIAL_REGEX = re.compile(r'[()\\]')
+PDF_REF_REGEX = re.compile(r'\s*\d+\s+\d+\s+R\s*\Z')
+
+class PDFRef(str):
+    '''an indirect reference, it behaves as its 'obj_id gen_id R' source text
+    but also carries the parsed object and generation numbers'''
+    def __new__(cls,obj_id,gen_id=0):
+        ref = str.__new__(cls,str(obj_id) + " " + str(gen_id) + " R")
+        ref.obj_id = obj_id
+        ref.gen_id = gen_id
+        return ref
+
+    def __reduce__(self):
+        return (PDFRef,(self.obj_id,self.gen_id))
+
+# Object numbers as written by hand or by PDFObject.get_obj_id, '12', '12 0',
+# '12 0 R', '12 0 obj' or '12-0'
+PDF_OBJ_KEY_REGEX = re.compile(r'\s*(\d+)(?:(?:\s+|-)(\d+))?')
+
+def parse_obj_key(text,gen_id=0):
+    '''return the object and generation numbers named by <text> as ints, <gen_id>
+    is used when the text only holds an object number'''
+    match = PDF_OBJ_KEY_REGEX.match(text)
+    if match is None:
+        raise ValueError(text)
+    if match.group(2) is not None:
+        gen_id = match.group(2)
+    return int(match.group(1)),int(gen_id)
+
+def is_pdf_ref(value):
+    '''check whether <value> is an indirect reference, either a PDFRef or
+    plain 'obj_id gen_id R' text'''
+    if isinstance(value,PDFRef):
+        return True
+    return isinstance(value,basestring) and value.endswith('R') and PDF_REF_REGEX.match(value) is not None
+
+class PDFLexer(object):
+    '''splits PDF source into tokens in a single left to right pass.  Each call
+    to next_token returns a (token_type,value,start) tuple, or None once the
+    end of the input is reached'''
+    def __init__(self,data,pos=0,end=None):
+        self.data = data
+        self.pos = pos
+        if end is None:
+            end = len(data)
+        self.end = end
+
+    def skip_whitespace(self):
+        '''move past whitespace and comments, returns the new position'''
+        self.pos = PDF_SKIP_REGEX.match(self.data,self.pos,self.end).end()
+        return self.pos
+
+    def next_token(self):
+        data = self.data
+        pos = self.skip_whitespace()
+        if pos >= self.end:
+            return None
+        c = data[pos]
+        if c == '/':
+            match = PDF_NAME_TOKEN_REGEX.match(data,pos,self.end)
+            self.pos = match.end()
+            return (TOKEN_NAME,match.group(),pos)
+        elif c in '0123456789+-.':
+            match = PDF_REF_TOKEN_REGEX.match(data,pos,self.end)
+            if match is not None:
+                self.pos = match.end()
+                return (TOKEN_REF,PDFRef(int(match.group(1)),int(match.group(2))),pos)
+            match = PDF_NUMBER_TOKEN_REGEX.match(data,pos,self.end)
+            if match is not None:
+                self.pos = match.end()
+                number = match.group()
+                if '.' in number:
+                    return (TOKEN_NUMBER,float(number),pos)
+                return (TOKEN_NUMBER,int(number),pos)
+        elif c == '(':
+            self.pos = self._scan_string(pos)
+            return (TOKEN_STRING,data[pos:self.pos],pos)
+        elif c == '<':
+            if data[pos+1:pos+2] == '<':
+                self.pos = pos + 2
+                return (TOKEN_DICT_START,'<<',pos)
+            match = PDF_HEXSTRING_TOKEN_REGEX.match(data,pos,self.end)
+            if match is None:
+                raise PDFFormatError("Invalid hex string at offset " + str(pos))
+            self.pos = match.end()
+            return (TOKEN_HEXSTRING,match.group(),pos)
+        elif c == '>':
+            if data[pos+1:pos+2] != '>':
+                raise PDFFormatError("Unexpected '>' at offset " + str(pos))
+            self.pos = pos + 2
+            return (TOKEN_DICT_END,'>>',pos)
+        elif c == '[':
+            self.pos = pos + 1
+            return (TOKEN_ARRAY_START,c,pos)
+        elif c == ']':
+            self.pos = pos + 1
+            return (TOKEN_ARRAY_END,c,pos)
+        elif c in '{}':
+            self.pos = pos + 1
+            return (TOKEN_KEYWORD,c,pos)
+        elif c == ')':
+            raise PDFFormatError("Unbalanced ')' at offset " + str(pos))
+        match = PDF_KEYWORD_TOKEN_REGEX.match(data,pos,self.end)
+        self.pos = match.end()
+        keyword = match.group()
+        if keyword == 'stream':
+            return (TOKEN_STREAM,keyword,pos)
+        return (TOKEN_KEYWORD,keyword,pos)
+
+    def _scan_string(self,pos):
+        '''return the offset just past the literal string starting at <pos>,
+        balanced parentheses and escapes are allowed inside the string'''
+        depth = 0
+        i = pos
+        while True:
+            match = PDF_STRING_SPECIAL_REGEX.search(self.data,i,self.end)
+            if match is None:
+                raise PDFFormatError("Unterminated string starting at offset " + str(pos))
+            i = match.start()
+            c = self.data[i]
+            if c == '\\':
+                i += 2
+                continue
+            if c == '(':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            i += 1
+
+    def skip_obj_header(self):
+        '''move past an 'obj_id gen_id obj' header if the input starts with one'''
+        match = PDF_OBJ_HEADER_REGEX.match(self.data,self.pos,self.end)
+        if match is not None:
+            self.pos = match.end()
+        return self.pos
+
+def _token_to_py_obj(token_type,value):
+    if token_type == TOKEN_KEYWORD:
+        if value == 'true':
+            return True
+        elif value == 'false':
+            return False
+        elif value == 'null':
+            return None
+    return value
+
+def _token_to_pdf_type(token_type,value):
+    if token_type == TOKEN_NAME:
+        return PDF_TYPE_NAME
+    elif token_type == TOKEN_NUMBER:
+        return PDF_TYPE_NUM
+    elif token_type == TOKEN_STRING or token_type == TOKEN_HEXSTRING:
+        return PDF_TYPE_STRING
+    elif token_type == TOKEN_REF:
+        return PDF_TYPE_REF
+    elif token_type == TOKEN_ARRAY_START:
+        return PDF_TYPE_ARRAY
+    elif token_type == TOKEN_DICT_START:
+        return PDF_TYPE_DICT
+    elif token_type == TOKEN_KEYWORD:
+        if value == 'true' or value == 'false':
+            return PDF_TYPE_BOOL
+        elif value == 'null':
+            return PDF_TYPE_NULL
+    return PDF_TYPE_INVALID
+
+# Deepest nesting of arrays and dictionaries the parser will follow
+PDF_MAX_NESTING = 200
+
+PDF_EOL_REGEX = re.compile(r'\r\n|\n|\r')
+PDF_ENDSTREAM_REGEX = re.compile(r'(?:\r\n|\n|\r)?endstream')
+
+class PDFParser(object):
+    '''recursive descent parser that pulls tokens from a PDFLexer and builds
+    python values directly, it can start at any offset in the buffer and runs
+    in time linear in the size of the input it reads'''
+    def __init__(self,data,pos=0,end=None):
+        self.data = data
+        self.lexer = PDFLexer(data,pos,end)
+        self.depth = 0
+
+    def get_position(self):
+        return self.lexer.pos
+
+    def parse_value(self,token=None):
+        '''parse the value that starts with <token>, or with the next token'''
+        if token is None:
+            token = self.lexer.next_token()
+            if token is None:
+                raise PDFFormatError("Unexpected end of input at offset " + str(self.lexer.pos))
+        token_type,value,start = token
+        if token_type == TOKEN_ARRAY_START or token_type == TOKEN_DICT_START:
+            if self.depth >= PDF_MAX_NESTING:
+                raise PDFFormatError("Value at offset " + str(start) + " is nested too deeply")
+            self.depth += 1
+            try:
+                if token_type == TOKEN_ARRAY_START:
+                    return self._parse_array(start)
+                return self._parse_dict(start)
+            finally:
+                self.depth -= 1
+        elif token_type == TOKEN_ARRAY_END or token_type == TOKEN_DICT_END or token_type == TOKEN_STREAM:
+            raise PDFFormatError("Unexpected '" + value + "' at offset " + str(start))
+        return _token_to_py_obj(token_type,value)
+
+    def _parse_array(self,start):
+        items = []
+        next_token = self.lexer.next_token
+        while True:
+            token = next_token()
+            if token is None:
+                raise PDFFormatError("Array starting at offset " + str(start) + " is not terminated")
+            if token[0] == TOKEN_ARRAY_END:
+                return items
+            items.append(self.parse_value(token))
+
+    def _parse_dict(self,start):
+        items = {}
+        next_token = self.lexer.next_token
+        while True:
+            token = next_token()
+            if token is None:
+                raise PDFFormatError("Dictionary starting at offset " + str(start) + " is not terminated")
+            if token[0] == TOKEN_DICT_END:
+                return items
+            if token[0] != TOKEN_NAME:
+                raise PDFFormatError("Dictionary key at offset " + str(token[2]) + " is not a name")
+            items[token[1]] = self.parse_value()
+
+    def parse_values(self):
+        '''parse values up to the end of the input or an endobj keyword'''
+        self.lexer.skip_obj_header()
+        values = []
+        while True:
+            token = self.lexer.next_token()
+            if token is None or (token[0] == TOKEN_KEYWORD and token[1] == 'endobj'):
+                return values
+            values.append(self.parse_value(token))
+
+    def parse_obj(self):
+        '''parse an object, either a full 'obj ... endobj' definition or a bare
+        value, returns a tuple of (obj_type,value)'''
+        lexer = self.lexer
+        start = lexer.skip_obj_header()
+        token = lexer.next_token()
+        if token is None:
+            return PDF_TYPE_INVALID,self.data[start:lexer.end].strip()
+        obj_type = _token_to_pdf_type(token[0],token[1])
+        value = self.parse_value(token)
+        end = lexer.pos
+        token = lexer.next_token()
+        if token is None or (token[0] == TOKEN_KEYWORD and token[1] == 'endobj'):
+            return obj_type,value
+        if token[0] == TOKEN_STREAM and obj_type == PDF_TYPE_DICT:
+            value = PDFStream(value)
+            value['stream'] = self._read_stream_data(token[2] + len('stream'),value.get('/Length'))
+            return PDF_TYPE_STREAM,value
+        return PDF_TYPE_INVALID,get_obj_content(self.data[start:lexer.end])
+
+    def _read_stream_data(self,pos,length):
+        '''read the data of a stream whose keyword ends at <pos>, trusting a
+        direct /Length when it lines up with the endstream keyword.  The data is
+        always copied out as a string, also from an mmap, see PDF.__init__'''
+        data = self.data
+        eol = PDF_EOL_REGEX.match(data,pos,self.lexer.end)
+        if eol is not None:
+            pos = eol.end()
+        if isinstance(length,(int,long)) and length >= 0:
+            endstream = PDF_ENDSTREAM_REGEX.match(data,pos+length,self.lexer.end)
+            if endstream is not None:
+                self.lexer.pos = endstream.end()
+                return data[pos:pos+length]
+        end = data.find('endstream',pos,self.lexer.end)
+        if end < 0:
+            raise PDFFormatError("Stream starting at offset " + str(pos) + " is not terminated by endstream")
+        self.lexer.pos = end + len('endstream')
+        if end - pos >= 2 and data[end-2:end] == '\r\n':
+            end -= 2
+        elif end > pos and data[end-1:end] in ('\r','\n'):
+            end -= 1
+        return data[pos:end]
+
+def parse_pdf_value(text,pos=0,end=None):
+    '''classify and convert PDF source, either a full 'obj ... endobj' definition
+    or a bare value, returns a tuple of (obj_type,value).  <text> may be any
+    buffer, such as an mmap, with <pos> and <end> bounding the object in it'''
+    return PDFParser(text,pos,end).parse_obj()
+
 def get_pdf_obj_type(obj):
     try:
         content = obj.content
@@ -47,60 +390,42 @@ def get_pdf_obj_type(obj):
     return _get_pdf_obj_type(content)
 
 def _get_pdf_obj_type(obj):
+    '''classify PDF source from its leading tokens, dictionaries are only read
+    as far as needed to tell them apart from streams'''
     if not isinstance(obj,basestring):
         raise PDFOperationError('Invalid PDF object: ' + str(obj))
-    obj = debone_pdf(get_obj_content(obj))
+    return classify_pdf_obj(obj)
+
+def classify_pdf_obj(data,pos=0,end=None):
+    '''classify the object between <pos> and <end> in the buffer <data>'''
+    lexer = PDFLexer(data,pos,end)
+    lexer.skip_obj_header()
     try:
-        float(obj)
-        return PDF_TYPE_NUM
-    except:
-        # Check for Object reference: OBJECT_NO 0 R
-        obj_type = re.findall(r'^\d+ \d+ R$',obj)
-        if len(obj_type) > 0:
-            return PDF_TYPE_REF
-        # Check for Array: [ ... ] 
-        obj_type = re.findall(r'^\[.*\]$',obj)
-        if len(obj_type) > 0:
-            return PDF_TYPE_ARRAY
-        # Check for String: ( ... )
-        obj_type = re.findall(r'^\(.*\)$',obj)
-        if len(obj_type) > 0:
-            return PDF_TYPE_STRING
-        # Check for Dictionary: << ... >>
-        obj_type = re.findall(r'^(\<\<.*\>\>)$',obj)
-        if len(obj_type) > 0:
-            return PDF_TYPE_DICT
-        # Check for Stream:
-        obj_type = re.findall(r'^\<\<.*\>\>\s+?stream.*endstream',obj,re.S)
-        if len(obj_type) > 0:
-            return PDF_TYPE_STREAM
-        # Check for String: < ... >
-        obj_type = re.findall(r'^(\<.*\>)$',obj)
-        if len(obj_type) > 0:
-            return PDF_TYPE_STRING
-        # Check for boolean: true
-        obj_type = re.findall(r'^true$',obj)
-        if len(obj_type) > 0:
-            return PDF_TYPE_BOOL
-        # Check for boolean: false 
-        obj_type = re.findall(r'^false$',obj)
-        if len(obj_type) > 0:
-            return PDF_TYPE_BOOL
-        # Check for null: null 
-        obj_type = re.findall(r'^null$',obj)
-        if len(obj_type) > 0:
-            return PDF_TYPE_NULL
-        # Check for name: /...
-        obj_type = re.findall(r'^/.*?$',obj)
-        if len(obj_type) > 0:
-            return PDF_TYPE_NAME
-    return PDF_TYPE_INVALID
-    
+        token = lexer.next_token()
+        if token is None:
+            return PDF_TYPE_INVALID
+        obj_type = _token_to_pdf_type(token[0],token[1])
+        if obj_type == PDF_TYPE_DICT:
+            depth = 1
+            while depth > 0:
+                token = lexer.next_token()
+                if token is None:
+                    return PDF_TYPE_INVALID
+                if token[0] == TOKEN_DICT_START:
+                    depth += 1
+                elif token[0] == TOKEN_DICT_END:
+                    depth -= 1
+            token = lexer.next_token()
+            if token is not None and token[0] == TOKEN_STREAM:
+                return PDF_TYPE_STREAM
+        return obj_type
+    except PDFFormatError:
+        return PDF_TYPE_INVALID
+
 def py_obj_to_pdf_obj(py_obj,obj_type=None,PDFObject=None):
     if PDFObject is not None:
         if isinstance(py_obj,PDFObject):
             if py_obj.is_trailer:
-                print py_obj.value
                 pdf_obj = "trailer\n"+_py_obj_to_pdf_obj(py_obj.value)
             else:
                 pdf_obj = str(py_obj.obj_id) + ' ' + str(py_obj.gen_id) + ' obj\n'
@@ -121,6 +446,8 @@ def _py_obj_to_pdf_obj(py_obj):
             pdf_obj = py_dict_to_pdf_dict(py_obj)
     elif isinstance(py_obj,list):
         pdf_obj = py_array_to_pdf_array(py_obj)
+    elif py_obj is None:
+        pdf_obj = "null"
     elif isinstance(py_obj,bool):
         pdf_obj = py_bool_to_pdf_bool(py_obj)
     elif isinstance(py_obj,(int,float,complex,long)):
@@ -174,6 +501,9 @@ def py_bool_to_pdf_bool(py_bool):
         return "false"
 
 def py_num_to_pdf_num(py_num):
+    if isinstance(py_num,float):
+        # PDF has no exponent notation, which str() falls back to for small values
+        return ('%.10f' % py_num).rstrip('0').rstrip('.')
     return str(py_num)
 
 def py_str_to_pdf_str(py_str):
@@ -184,43 +514,42 @@ def py_str_to_pdf_str(py_str):
     elif py_str.startswith('/'):
         return py_str
     else:
-        if get_pdf_obj_type(py_str) == PDF_TYPE_REF:
+        if is_pdf_ref(py_str):
             return py_str
         return '(' + py_str + ')'
 
+PDF_STRING_ESCAPE_REGEX = re.compile(r'\\([0-7]{1,3}|\r\n|[\s\S])|\r\n?')
+PDF_STRING_ESCAPES = {'n':'\n','r':'\r','t':'\t','b':'\b','f':'\f','\r':'','\n':'','\r\n':''}
+
+def _unescape_pdf_string(match):
+    escape = match.group(1)
+    if escape is None:
+        return '\n'
+    elif escape[0] in '01234567':
+        return chr(int(escape,8) & 0xff)
+    return PDF_STRING_ESCAPES.get(escape,escape)
+
+def decode_pdf_string(value):
+    '''return the bytes held by the literal '(...)' or hex '<...>' string source
+    <value>, escapes are replaced and line ends in literals read as \\n'''
+    if value.startswith('('):
+        return PDF_STRING_ESCAPE_REGEX.sub(_unescape_pdf_string,value[1:-1])
+    elif value.startswith('<'):
+        return ascii_hex_decode(value[1:])
+    return value
+
 def pdf_obj_to_py_obj(pdf_obj):
-    obj_type = pdf_obj.obj_type
-    content = pdf_obj.content
-    return _pdf_obj_to_py_obj(content,obj_type=None)
+    return _pdf_obj_to_py_obj(pdf_obj.content)
 
 def _pdf_obj_to_py_obj(pdf_obj,obj_type=None):
-    if obj_type is None:
-        obj_type = _get_pdf_obj_type(pdf_obj)
-    pdf_obj = get_obj_content(pdf_obj)
-    value = None
-    if obj_type == PDF_TYPE_DICT:
-        value = pdf_dict_to_py_dict(pdf_obj)
-    elif obj_type == PDF_TYPE_ARRAY:
-        value = pdf_array_to_py_array(pdf_obj)
-    elif obj_type == PDF_TYPE_NUM:
-        value = pdf_num_to_py_num(pdf_obj)
-    elif obj_type == PDF_TYPE_STREAM:
-        value = pdf_stream_to_py_dict(pdf_obj)
-    elif obj_type == PDF_TYPE_REF:
-        value = pdf_ref_to_py_str(pdf_obj)
-    elif obj_type == PDF_TYPE_BOOL:
-        value = pdf_bool_to_py_bool(pdf_obj)
-    elif obj_type == PDF_TYPE_NAME:
-        value = pdf_name_to_py_str(pdf_obj)
-    elif obj_type == PDF_TYPE_NULL:
-        return None    
-    else:
-        value = pdf_obj
-    if value is None:
-        raise PDFOperationError("Invalid obj format: '"+str(pdf_obj)+"' of type '" + pdf_type_to_str(obj_type) + "'")
-    else:
-        return value
+    return parse_pdf_obj(pdf_obj)[1]
 
+def parse_pdf_obj(pdf_obj,pos=0,end=None):
+    '''convert PDF source into a tuple of (obj_type,python value)'''
+    try:
+        return parse_pdf_value(pdf_obj,pos,end)
+    except PDFFormatError as e:
+        raise PDFOperationError("Invalid obj format: '" + pdf_obj[pos:pos+64] + "': " + str(e))
 
 def pdf_ref_to_py_str(ref):
     return ref
@@ -250,117 +579,276 @@ def pdf_bool_to_py_bool(boolean):
         return None
 
 def pdf_array_to_py_array(a):
+    '''convert a PDF array, or a bare sequence of values, into a list'''
     try:
-        content = get_obj_content(a)
-        if content is not None:
-            a = content
-        a = a.strip()
-        if a.startswith('[') and a.endswith(']'):
-            a = a[1:-1]
-        a = debone_pdf(a)
-        if len(a) == 0:
-            return []
-        a = a.split(' ')
-        py_a = []
-        buf = []
-        while len(a) > 0:
-            if a[0].startswith('('):
-                while len(buf) > 0:
-                    py_a.append(_pdf_obj_to_py_obj(buf[0]))
-                    buf = buf[1:]
-                str_buf = ''
-                while len(a) > 0:
-                    str_buf += a[0] + ' '
-                    a = a[1:]
-                    if str_buf.endswith(') '):
-                        str_buf = str_buf[:-1]
-                        break
-                py_a.append(_pdf_obj_to_py_obj(str_buf))
-            elif a[0].startswith('['):
-                while len(buf) > 0:
-                    py_a.append(_pdf_obj_to_py_obj(buf[0]))
-                    buf = buf[1:]
-                str_buf = ''
-                depth_count = 0
-                while len(a) > 0:
-                    str_buf += a[0] + ' '
-                    if a[0].startswith('['):
-                        depth_count += 1
-                    if str_buf.endswith('] '):
-                        depth_count += -1
-                    a = a[1:]
-                    if depth_count == 0:
-                        break
-                py_a.append(_pdf_obj_to_py_obj(str_buf))
-            elif a[0].startswith('<<'):
-                while len(buf) > 0:
-                    py_a.append(_pdf_obj_to_py_obj(buf[0]))
-                    buf = buf[1:]
-                str_buf = ''
-                depth_count = 0
-                while len(a) > 0:
-                    str_buf += a[0] + ' '
-                    if a[0].startswith('<<'):
-                        depth_count += 1
-                    if str_buf.endswith('>> '):
-                        depth_count += -1
-                    a = a[1:]
-                    if depth_count == 0:
-                        str_buf = str_buf[:-1]
-                        break
-                py_a.append(_pdf_obj_to_py_obj(str_buf))
-            elif a[0].startswith('<'):
-                while len(buf) > 0:
-                    py_a.append(_pdf_obj_to_py_obj(buf[0]))
-                    buf = buf[1:]
-                str_buf = ''    
-                while len(a) > 0:
-                    str_buf += a[0] + ' '
-                    a = a[1:]
-                    if str_buf.endswith('> '):
-                        str_buf = str_buf[:-1]
-                        break
-                py_a.append(_pdf_obj_to_py_obj(str_buf))
-            else:
-                buf.append(a[0])
-                if len(buf) >= 3:
-                    t = ' '.join(i for i in buf)
-                    if buf[-1] == 'R' and _get_pdf_obj_type(t) == PDF_TYPE_REF:
-                        py_a.append(_pdf_obj_to_py_obj(t))
-                        buf = []
-                    else:
-                        py_a.append(_pdf_obj_to_py_obj(buf[0]))
-                        buf = buf[1:]
-                a = a[1:]
-        while len(buf) > 0:
-            py_a.append(_pdf_obj_to_py_obj(buf[0]))
-            buf = buf[1:]
-        return py_a
-    except Exception as e:
+        values = PDFParser(a).parse_values()
+    except PDFFormatError:
         return None
+    if len(values) == 1 and isinstance(values[0],list):
+        return values[0]
+    return values
 
 def pdf_dict_to_py_dict(d):
-    d = debone_pdf(d)
-    if d.startswith('<<') and d.endswith('>>'):
-        d = d[2:-2]
-    py_a = pdf_array_to_py_array(d)
+    '''convert a PDF dictionary, or a bare sequence of key value pairs, into
+    a dict'''
+    values = PDFParser(d).parse_values()
+    if len(values) == 1 and isinstance(values[0],dict):
+        return values[0]
     py_d = {}
-    for i in range(0,len(py_a),2):
-        py_d[py_a[i]] = py_a[i+1]
-    return py_d        
+    for i in range(0,len(values),2):
+        py_d[values[i]] = values[i+1]
+    return py_d
 
 def pdf_stream_to_py_dict(s):
-    d,s = splitstream(s)
-    if len(s) <= 0:
+    obj_type,value = parse_pdf_value(s)
+    if obj_type != PDF_TYPE_STREAM:
         return None
-    d = pdf_dict_to_py_dict(d)
-    d['stream'] = re.findall(r'stream(.*)endstream',s,re.S)[0]
-    try:
-        filters = d['/Filter']
-    except:
-        filters = []
-    d['stream_decoded'] = stream_decode(d['stream'],filters)
-    return d
+    return value
+
+# Default number of decoded bytes a PDFStreamCache may hold
+DEFAULT_STREAM_CACHE_BYTES = 32*1024*1024
+
+# Streams handed to each thread at a time by PDF.decode_streams, between
+# batches it checks whether the stream cache has room for more
+PDF_DECODE_BATCH_SIZE = 4
+
+# Largest piece of decoded data handled at a time when streams are decoded
+# incrementally
+DEFAULT_DECODE_CHUNK_SIZE = 64*1024
+
+class PDFStreamCache(object):
+    '''least recently used cache of decoded stream data, bounded by the total
+    number of decoded bytes held rather than the number of streams'''
+    def __init__(self,max_bytes=DEFAULT_STREAM_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self,key,decode):
+        '''return the decoded data stored under <key>, calling <decode> to
+        produce it on a miss'''
+        try:
+            data = self._entries.pop(key)
+            self._entries[key] = data
+            self.hits += 1
+            return data
+        except KeyError:
+            self.misses += 1
+        data = decode()
+        self.put(key,data)
+        return data
+
+    def put(self,key,data):
+        '''store <data> under <key>, evicting the least recently used entries
+        until the cache is back within its budget'''
+        self.discard(key)
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            old_key,old_data = self._entries.popitem(last=False)
+            self.size -= len(old_data)
+
+    def lookup(self,key):
+        '''return the data stored under <key> or None, for callers that decode a
+        miss themselves without storing it.  The lookup is counted and the entry
+        marked as used'''
+        try:
+            data = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = data
+        self.hits += 1
+        return data
+
+    def has_room(self,size):
+        '''whether <size> more bytes can be stored without evicting anything'''
+        return self.size + size <= self.max_bytes
+
+    def discard(self,key):
+        '''drop the entry stored under <key>, if any'''
+        data = self._entries.pop(key,None)
+        if data is not None:
+            self.size -= len(data)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def hit_rate(self):
+        '''fraction of lookups served from the cache'''
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits)/lookups
+
+    def stats(self):
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'hit_rate' : self.hit_rate(),
+            'entries' : len(self._entries),
+            'size' : self.size,
+            'max_bytes' : self.max_bytes,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+_stream_keys = itertools.count()
+
+class PDFStream(dict):
+    '''dictionary holding a stream object, 'stream' holds the raw data and
+    'stream_decoded' is decoded the first time it is looked up, through the
+    PDFStreamCache in <cache> when one is set.  Decoding more than <max_size>
+    bytes raises a PDFOperationError'''
+    def __init__(self,*args,**kwargs):
+        dict.__init__(self,*args,**kwargs)
+        self.cache = None
+        self.max_size = None
+        self.key = next(_stream_keys)
+
+    def __missing__(self,key):
+        if key != 'stream_decoded':
+            raise KeyError(key)
+        if self.cache is None:
+            return self.decode()
+        return self.cache.get(self.key,self.decode)
+
+    def __setitem__(self,key,value):
+        if key in ('stream','/Filter') and self.cache is not None:
+            self.cache.discard(self.key)
+        dict.__setitem__(self,key,value)
+
+    def __delitem__(self,key):
+        if key in ('stream','/Filter') and self.cache is not None:
+            self.cache.discard(self.key)
+        dict.__delitem__(self,key)
+
+    def get_filters(self):
+        '''return the /Filter and /DecodeParms of the stream with any indirect
+        references followed'''
+        return resolve_pdf_value(self.get('/Filter',[])),resolve_pdf_value(self.get('/DecodeParms'))
+
+    def decode(self):
+        '''decode the raw stream data through its filters, bypassing the cache'''
+        filters,parms = self.get_filters()
+        return stream_decode(self['stream'],filters,parms,self.max_size)
+
+    def iter_decoded(self,chunk_size=DEFAULT_DECODE_CHUNK_SIZE):
+        '''yield the decoded data a chunk at a time.  Data already in the cache is
+        read from there, otherwise the whole of it is never held at once'''
+        data = None
+        if self.cache is not None:
+            data = self.cache.lookup(self.key)
+        if data is not None:
+            return (data[i:i+chunk_size] for i in xrange(0,len(data),chunk_size))
+        filters,parms = self.get_filters()
+        return stream_decode_iter(self['stream'],filters,parms,self.max_size,chunk_size)
+
+    def open(self,chunk_size=DEFAULT_DECODE_CHUNK_SIZE):
+        '''return a file-like object reading the decoded data'''
+        return PDFStreamReader(self.iter_decoded(chunk_size))
+
+class PDFStreamReader(object):
+    '''read only file-like object over decoded stream data that is produced a
+    chunk at a time'''
+    def __init__(self,chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self.closed = False
+
+    def _fill(self,size=None):
+        '''read chunks into the buffer until it holds <size> bytes, or the data
+        runs out when size is None'''
+        pieces = [self._buffer]
+        length = len(self._buffer)
+        for chunk in self._chunks:
+            pieces.append(chunk)
+            length += len(chunk)
+            if size is not None and length >= size:
+                break
+        self._buffer = ''.join(pieces)
+
+    def read(self,size=-1):
+        if size is None or size < 0:
+            self._fill()
+            data,self._buffer = self._buffer,''
+            return data
+        if len(self._buffer) < size:
+            self._fill(size)
+        data,self._buffer = self._buffer[:size],self._buffer[size:]
+        return data
+
+    def readline(self):
+        while True:
+            end = PDF_EOL_REGEX.search(self._buffer)
+            # a \r at the end of the buffer may be the start of a \r\n
+            if end is not None and not (end.group(0) == '\r' and end.end() == len(self._buffer)):
+                break
+            length = len(self._buffer)
+            self._fill(length + DEFAULT_DECODE_CHUNK_SIZE)
+            if len(self._buffer) == length:
+                data,self._buffer = self._buffer,''
+                return data
+        data,self._buffer = self._buffer[:end.end()],self._buffer[end.end():]
+        return data
+
+    def __iter__(self):
+        return iter(self.readline,'')
+
+    def close(self):
+        self._chunks = iter(())
+        self._buffer = ''
+        self.closed = True
+
+def copy_pdf_value(value):
+    '''copy the dictionaries and arrays that make up <value>, anything else such as
+    strings or links to other objects is shared with the copy'''
+    if isinstance(value,PDFStream):
+        copy = PDFStream((key,copy_pdf_value(value[key])) for key in value)
+        copy.cache = value.cache
+        copy.max_size = value.max_size
+        return copy
+    elif isinstance(value,dict):
+        return dict((key,copy_pdf_value(value[key])) for key in value)
+    elif isinstance(value,list):
+        return [copy_pdf_value(item) for item in value]
+    return value
+
+# Version of the parse cache format written by PDF, caches of other versions
+# are ignored
+PDF_CACHE_VERSION = 1
+
+# Objects whose source is longer than this are not kept in the parse cache
+PDF_CACHE_MAX_OBJ_SIZE = 4096
+
+def pack_pdf_value(value):
+    '''convert a parsed, non-stream <value> into builtin types that marshal can
+    write, references and links to objects become (obj_id,gen_id) tuples'''
+    if isinstance(value,PDFRef) or hasattr(value,'indirect_ref'):
+        return (value.obj_id,value.gen_id)
+    elif isinstance(value,dict):
+        return dict((key,pack_pdf_value(value[key])) for key in value)
+    elif isinstance(value,list):
+        return [pack_pdf_value(item) for item in value]
+    elif isinstance(value,str):
+        return str(value)
+    return value
+
+def unpack_pdf_value(value):
+    '''rebuild a value written by pack_pdf_value'''
+    if isinstance(value,tuple):
+        return PDFRef(*value)
+    elif isinstance(value,dict):
+        return dict((key,unpack_pdf_value(value[key])) for key in value)
+    elif isinstance(value,list):
+        return [unpack_pdf_value(item) for item in value]
+    return value
 
 def iswhitespace(char):
     return len(char.strip()) == 0
@@ -382,22 +870,681 @@ def debone_pdf(pdf_text):
     else:
         return pdf_text 
 
-def stream_decode(stream,filters):
-    _stream = stream
-    if isinstance(filters,basestring):
-        _filter = filters
-        if _filter == "/FlateDecode":
-            _stream = zlib.decompress(_stream.strip("\r").strip("\n"))
-        elif _filter == "/ASCIIHexDecode":
-            print "/ASCII"
-            _stream = binascii.unhexlify(_stream.replace("\r","").replace("\n","").replace(" ","").strip("<").strip(">"))
+def flate_decode(data,max_size=None):
+    '''inflate <data> in one go, raising a PDFOperationError when it decodes to
+    more than <max_size> bytes or is not valid zlib data'''
+    data = data.lstrip("\r\n")
+    try:
+        if max_size is None:
+            return zlib.decompressobj().decompress(data)
+        decoded = zlib.decompressobj().decompress(data,max_size+1)
+    except zlib.error as e:
+        raise PDFOperationError("Flate stream could not be decoded: " + str(e))
+    if len(decoded) > max_size:
+        raise PDFOperationError("Stream decodes to more than the limit of " + str(max_size) + " bytes")
+    return decoded
+
+def flate_decode_iter(data,max_size=None,chunk_size=DEFAULT_DECODE_CHUNK_SIZE):
+    '''inflate <data> incrementally, yielding chunks of at most <chunk_size> bytes,
+    raises a PDFOperationError once more than <max_size> bytes are produced or
+    when the data is not valid zlib data'''
+    data = data.lstrip("\r\n")
+    decompressor = zlib.decompressobj()
+    size = 0
+    pos = 0
+    while True:
+        try:
+            if decompressor.unconsumed_tail:
+                chunk = decompressor.decompress(decompressor.unconsumed_tail,chunk_size)
+            elif pos < len(data) and not decompressor.unused_data:
+                chunk = decompressor.decompress(data[pos:pos+chunk_size],chunk_size)
+                pos += chunk_size
+            else:
+                chunk = decompressor.flush()
+                if len(chunk) == 0:
+                    return
+        except zlib.error as e:
+            raise PDFOperationError("Flate stream could not be decoded: " + str(e))
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise PDFOperationError("Stream decodes to more than the limit of " + str(max_size) + " bytes")
+        if len(chunk) > 0:
+            yield chunk
+
+def stream_decode_iter(stream,filters,parms=None,max_size=None,chunk_size=DEFAULT_DECODE_CHUNK_SIZE):
+    '''decode <stream> through <filters>, yielding the data a chunk at a time.  A
+    lone /FlateDecode, with or without a predictor, is decoded incrementally,
+    other filters are decoded whole and then split into chunks'''
+    if isinstance(filters,list) and len(filters) == 1:
+        filters = filters[0]
+        if isinstance(parms,list):
+            parms = resolve_pdf_value(parms[0]) if len(parms) > 0 else None
+    if isinstance(filters,basestring) and PDF_FILTER_NAMES.get(filters,filters) == "/FlateDecode":
+        chunks = flate_decode_iter(stream,max_size,chunk_size)
+        predictor = get_predictor(parms)
+        if predictor is not None:
+            chunks = _unpredict_iter(chunks,*predictor)
+        for chunk in chunks:
+            yield chunk
+        return
+    if filters:
+        data = stream_decode(stream,filters,parms,max_size)
+    else:
+        data = stream
+        if max_size is not None and len(data) > max_size:
+            raise PDFOperationError("Stream decodes to more than the limit of " + str(max_size) + " bytes")
+    for i in xrange(0,len(data),chunk_size):
+        yield data[i:i+chunk_size]
+
+def _unpredict_iter(chunks,predictor,row_length,pixel_length):
+    '''undo a predictor over decoded data arriving in <chunks>, whole rows are
+    handed on as they become complete'''
+    if predictor == 2:
+        unit = row_length
+    else:
+        unit = row_length + 1
+    buf = ''
+    previous = None
+    for chunk in chunks:
+        buf += chunk
+        end = len(buf) - len(buf) % unit
+        if end == 0:
+            continue
+        if predictor == 2:
+            data = tiff_unpredict(buf[:end],row_length,pixel_length)
+        else:
+            data = png_unpredict(buf[:end],row_length,pixel_length,previous)
+            previous = bytearray(data[-row_length:])
+        buf = buf[end:]
+        yield data
+    if len(buf) > 0:
+        if predictor == 2:
+            yield tiff_unpredict(buf,row_length,pixel_length)
+        else:
+            yield png_unpredict(buf,row_length,pixel_length,previous)
+
+PDF_WHITESPACE_REGEX = re.compile(r'[\x00\t\n\x0c\r ]+')
+
+# Stream filters, PDF_FILTERS maps each filter name to a function taking the
+# encoded data, the filter's /DecodeParms dictionary (or None) and a limit on
+# the decoded size (or None), and returning the decoded data
+PDF_FILTERS = {}
+
+# Abbreviated filter names, as used by inline images
+PDF_FILTER_NAMES = {
+    '/AHx' : '/ASCIIHexDecode',
+    '/A85' : '/ASCII85Decode',
+    '/LZW' : '/LZWDecode',
+    '/Fl' : '/FlateDecode',
+    '/RL' : '/RunLengthDecode',
+    '/CCF' : '/CCITTFaxDecode',
+    '/DCT' : '/DCTDecode',
+}
+
+# Image codecs, their data is handed on as it is for an image decoder
+PDF_IMAGE_FILTERS = ('/DCTDecode','/JPXDecode','/CCITTFaxDecode','/JBIG2Decode')
+
+def is_image_filter(filters):
+    '''whether the last of <filters>, a name or a list of them, is an image codec
+    whose data stream_decode passes through unchanged'''
+    if isinstance(filters,list):
+        if len(filters) == 0:
+            return False
+        filters = filters[-1]
+    return PDF_FILTER_NAMES.get(filters,filters) in PDF_IMAGE_FILTERS
+
+def register_filter(name,decode):
+    '''decode streams using the filter <name> with the function <decode>, see
+    PDF_FILTERS'''
+    PDF_FILTERS[name] = decode
+
+def check_decoded_size(data,max_size):
+    if max_size is not None and len(data) > max_size:
+        raise PDFOperationError("Stream decodes to more than the limit of " + str(max_size) + " bytes")
+    return data
+
+def stream_decode(stream,filters,parms=None,max_size=None):
+    '''decode <stream> through each of <filters> in order.  <parms> holds the
+    /DecodeParms, either one dictionary used by every filter or a list with an
+    entry for each filter'''
+    if not filters:
+        return check_decoded_size(stream,max_size)
+    if not isinstance(filters,list):
+        filters = [filters]
+    for i,_filter in enumerate(filters):
+        _filter = PDF_FILTER_NAMES.get(_filter,_filter)
+        if isinstance(parms,list):
+            _parms = resolve_pdf_value(parms[i]) if i < len(parms) else None
         else:
-            print "other decode"
+            _parms = parms
+        try:
+            decode = PDF_FILTERS[_filter]
+        except (KeyError,TypeError):
+            raise PDFOperationError("Unsupported stream filter " + str(_filter))
+        stream = decode(stream,_parms,max_size)
+    return stream
+
+def _decode_flate(data,parms,max_size):
+    return stream_unpredict(flate_decode(data,max_size),parms)
+
+def _decode_lzw(data,parms,max_size):
+    return stream_unpredict(lzw_decode(data,parms,max_size),parms)
+
+def _decode_ascii_hex(data,parms,max_size):
+    return check_decoded_size(ascii_hex_decode(data),max_size)
+
+def _decode_ascii85(data,parms,max_size):
+    return check_decoded_size(ascii85_decode(data),max_size)
+
+def _decode_run_length(data,parms,max_size):
+    return check_decoded_size(run_length_decode(data),max_size)
+
+def _decode_image(data,parms,max_size):
+    # image codecs are left encoded for whatever displays the image
+    return data
+
+def _decode_crypt(data,parms,max_size):
+    if isinstance(parms,dict) and parms.get('/Name','/Identity') != '/Identity':
+        raise PDFOperationError("Unsupported crypt filter " + str(parms.get('/Name')))
+    return data
+
+def ascii_hex_decode(data):
+    '''decode /ASCIIHexDecode data, whitespace is ignored, data ends at '>' and an
+    odd final digit is read as if followed by 0'''
+    end = data.find('>')
+    if end >= 0:
+        data = data[:end]
+    data = PDF_WHITESPACE_REGEX.sub('',data)
+    if len(data) % 2 == 1:
+        data += '0'
+    try:
+        return binascii.unhexlify(data)
+    except (TypeError,binascii.Error):
+        raise PDFOperationError("Invalid /ASCIIHexDecode stream data")
+
+def ascii85_decode(data):
+    '''decode /ASCII85Decode data, whitespace is ignored and data ends at '~>' '''
+    data = data.strip()
+    if data.startswith('<~'):
+        data = data[2:]
+    end = data.find('~>')
+    if end >= 0:
+        data = data[:end]
+    data = PDF_WHITESPACE_REGEX.sub('',data)
+    out = []
+    group = []
+    for char in data:
+        if char == 'z' and len(group) == 0:
+            out.append('\0\0\0\0')
+            continue
+        code = ord(char) - 33
+        if code < 0 or code > 84:
+            raise PDFOperationError("Invalid character " + repr(char) + " in /ASCII85Decode stream data")
+        group.append(code)
+        if len(group) == 5:
+            out.append(_ascii85_group(group))
+            group = []
+    if len(group) == 1:
+        raise PDFOperationError("Invalid final group in /ASCII85Decode stream data")
+    if len(group) > 0:
+        count = len(group)
+        out.append(_ascii85_group(group + [84]*(5-count))[:count-1])
+    return ''.join(out)
+
+def _ascii85_group(group):
+    value = 0
+    for code in group:
+        value = value*85 + code
+    if value > 0xffffffff:
+        raise PDFOperationError("Invalid group in /ASCII85Decode stream data")
+    return chr(value >> 24) + chr((value >> 16) & 0xff) + chr((value >> 8) & 0xff) + chr(value & 0xff)
+
+def lzw_decode(data,parms=None,max_size=None):
+    '''decode /LZWDecode data, codes of 9 to 12 bits with code 256 clearing the
+    table and 257 ending the data.  With /EarlyChange 1, the default, code
+    widths grow one code earlier than the table does'''
+    early = 1
+    if isinstance(parms,dict):
+        early = resolve_pdf_value(parms.get('/EarlyChange',1))
+    table = [chr(i) for i in range(256)] + [None,None]
+    out = []
+    size = 0
+    width = 9
+    previous = None
+    bits = 0
+    bit_count = 0
+    for char in data:
+        bits = (bits << 8) | ord(char)
+        bit_count += 8
+        while bit_count >= width:
+            bit_count -= width
+            code = (bits >> bit_count) & ((1 << width) - 1)
+            bits &= (1 << bit_count) - 1
+            if code == 256:
+                table = table[:258]
+                width = 9
+                previous = None
+                continue
+            elif code == 257:
+                return ''.join(out)
+            if previous is None:
+                entry = table[code]
+            elif code < len(table):
+                entry = table[code]
+                table.append(previous + entry[0])
+            elif code == len(table):
+                entry = previous + previous[0]
+                table.append(entry)
+            else:
+                raise PDFOperationError("Invalid code " + str(code) + " in /LZWDecode stream data")
+            out.append(entry)
+            size += len(entry)
+            if max_size is not None and size > max_size:
+                raise PDFOperationError("Stream decodes to more than the limit of " + str(max_size) + " bytes")
+            previous = entry
+            if len(table) + early >= (1 << width) and width < 12:
+                width += 1
+    return ''.join(out)
+
+def run_length_decode(data):
+    '''decode /RunLengthDecode data, a length byte of 0 to 127 is followed by that
+    many plus one literal bytes, 129 to 255 by one byte repeated 257 less the
+    length times, and 128 ends the data'''
+    out = []
+    pos = 0
+    while pos < len(data):
+        length = ord(data[pos])
+        if length == 128:
+            break
+        elif length < 128:
+            out.append(data[pos+1:pos+2+length])
+            pos += length + 2
+        else:
+            out.append(data[pos+1:pos+2]*(257-length))
+            pos += 2
+    return ''.join(out)
+
+register_filter('/FlateDecode',_decode_flate)
+register_filter('/LZWDecode',_decode_lzw)
+register_filter('/ASCIIHexDecode',_decode_ascii_hex)
+register_filter('/ASCII85Decode',_decode_ascii85)
+register_filter('/RunLengthDecode',_decode_run_length)
+register_filter('/Crypt',_decode_crypt)
+for _filter in PDF_IMAGE_FILTERS:
+    register_filter(_filter,_decode_image)
+
+def get_predictor(parms):
+    '''return (predictor,row_length,pixel_length) for the predictor named in the
+    /DecodeParms dictionary <parms>, or None when there is none'''
+    if not isinstance(parms,dict):
+        return None
+    predictor = resolve_pdf_value(parms.get('/Predictor',1))
+    if predictor <= 1:
+        return None
+    columns = resolve_pdf_value(parms.get('/Columns',1))
+    colors = resolve_pdf_value(parms.get('/Colors',1))
+    bits = resolve_pdf_value(parms.get('/BitsPerComponent',8))
+    if predictor == 2 and bits != 8:
+        raise PDFOperationError("TIFF predictor is only supported for 8 bit components")
+    return predictor,(colors*bits*columns+7)//8,max(1,(colors*bits+7)//8)
+
+def stream_unpredict(data,parms):
+    '''undo the PNG or TIFF predictor named in the /DecodeParms dictionary
+    <parms>, if any'''
+    predictor = get_predictor(parms)
+    if predictor is None:
+        return data
+    predictor,row_length,pixel_length = predictor
+    if predictor == 2:
+        return tiff_unpredict(data,row_length,pixel_length)
+    return png_unpredict(data,row_length,pixel_length)
+
+def png_unpredict(data,row_length,pixel_length,previous=None):
+    '''undo PNG row filters, each row is prefixed by its filter type.  <previous>
+    is the row before the data, when it continues earlier rows'''
+    if numpy is not None:
+        return _png_unpredict_numpy(data,row_length,pixel_length,previous)
+    rows = []
+    if previous is None:
+        previous = bytearray(row_length)
+    for start in xrange(0,len(data),row_length+1):
+        row = bytearray(data[start+1:start+1+row_length])
+        _png_unpredict_row(ord(data[start]),row,previous,pixel_length)
+        rows.append(str(row))
+        previous = row
+    return ''.join(rows)
+
+def _png_unpredict_row(filter_type,row,previous,pixel_length):
+    '''undo the PNG filter <filter_type> on the bytearray <row> in place'''
+    if filter_type == 1:
+        for i in xrange(pixel_length,len(row)):
+            row[i] = (row[i] + row[i-pixel_length]) & 0xff
+    elif filter_type == 2:
+        for i in xrange(len(row)):
+            row[i] = (row[i] + previous[i]) & 0xff
+    elif filter_type == 3:
+        for i in xrange(len(row)):
+            left = row[i-pixel_length] if i >= pixel_length else 0
+            row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+    elif filter_type == 4:
+        for i in xrange(len(row)):
+            left = row[i-pixel_length] if i >= pixel_length else 0
+            upper_left = previous[i-pixel_length] if i >= pixel_length else 0
+            row[i] = (row[i] + paeth_predictor(left,previous[i],upper_left)) & 0xff
+    elif filter_type != 0:
+        raise PDFOperationError("Unknown PNG predictor filter type " + str(filter_type))
+
+def _png_unpredict_numpy(data,row_length,pixel_length,previous=None):
+    '''png_unpredict working on whole rows with numpy.  Runs of Up rows are
+    summed down the columns in one step and Sub rows across the pixels, the
+    Average and Paeth filters depend on the bytes to their left as they are
+    decoded and go through _png_unpredict_row'''
+    unit = row_length + 1
+    size = len(data) - len(data)//unit - (1 if len(data) % unit else 0)
+    if len(data) % unit:
+        data += '\0'*(unit - len(data) % unit)
+    encoded = numpy.frombuffer(data,dtype=numpy.uint8).reshape(-1,unit)
+    filter_types = encoded[:,0]
+    rows = encoded[:,1:].copy()
+    if previous is None:
+        last = numpy.zeros(row_length,dtype=numpy.uint8)
     else:
-        for _filter in filters:
-            _stream = stream_decode(_stream,_filter)
-    return _stream
+        last = numpy.frombuffer(str(previous),dtype=numpy.uint8)
+    sub_ok = row_length % pixel_length == 0
+    i = 0
+    count = len(rows)
+    while i < count:
+        filter_type = filter_types[i]
+        if filter_type == 2:
+            j = i + 1
+            while j < count and filter_types[j] == 2:
+                j += 1
+            rows[i:j] = numpy.cumsum(rows[i:j],axis=0,dtype=numpy.uint8) + last
+            i = j
+        else:
+            if filter_type == 1 and sub_ok:
+                rows[i] = numpy.cumsum(rows[i].reshape(-1,pixel_length),axis=0,dtype=numpy.uint8).reshape(-1)
+            elif filter_type != 0:
+                row = bytearray(rows[i].tostring())
+                _png_unpredict_row(filter_type,row,bytearray(last.tostring()),pixel_length)
+                rows[i] = numpy.frombuffer(str(row),dtype=numpy.uint8)
+            i += 1
+        last = rows[i-1]
+    return rows.tostring()[:size]
+
+def paeth_predictor(left,up,upper_left):
+    p = left + up - upper_left
+    pa = abs(p - left)
+    pb = abs(p - up)
+    pc = abs(p - upper_left)
+    if pa <= pb and pa <= pc:
+        return left
+    elif pb <= pc:
+        return up
+    return upper_left
+
+def tiff_unpredict(data,row_length,pixel_length):
+    '''undo TIFF predictor 2, horizontal differencing of 8 bit components'''
+    if numpy is not None and row_length % pixel_length == 0:
+        size = len(data)
+        if size % row_length:
+            data += '\0'*(row_length - size % row_length)
+        rows = numpy.frombuffer(data,dtype=numpy.uint8).reshape(-1,row_length//pixel_length,pixel_length)
+        return numpy.cumsum(rows,axis=1,dtype=numpy.uint8).tostring()[:size]
+    rows = []
+    for start in xrange(0,len(data),row_length):
+        row = bytearray(data[start:start+row_length])
+        for i in xrange(pixel_length,len(row)):
+            row[i] = (row[i] + row[i-pixel_length]) & 0xff
+        rows.append(str(row))
+    return ''.join(rows)
+
+def resolve_pdf_value(value):
+    '''follow links to PDFObjects through to the value they hold'''
+    while hasattr(value,'indirect_ref'):
+        value = value.value
+    return value
+
+
+PDF_HEADER_REGEX = re.compile(r'%PDF-\d+\.\d+')
+PDF_OBJ_HEADER_REGEX = re.compile(r'\s*(\d+)\s+(\d+)\s+obj')
+PDF_XREF_SUBSECTION_REGEX = re.compile(r'\s*(\d+)\s+(\d+)[ \t]*[\r\n]')
+PDF_XREF_ENTRY_REGEX = re.compile(r'\s*(\d{1,10})\s+(\d{1,5})\s+([nf])')
+PDF_STARTXREF_REGEX = re.compile(r'startxref\s+(\d+)')
+PDF_PREV_REGEX = re.compile(r'/Prev\s+(\d+)')
+PDF_XREFSTM_REGEX = re.compile(r'/XRefStm\s+(\d+)')
+
+def find_startxref(content):
+    '''return the offset recorded by the last startxref keyword in <content>'''
+    index = content.rfind('startxref')
+    if index < 0:
+        raise PDFFormatError("PDF does not contain a startxref entry")
+    match = PDF_STARTXREF_REGEX.match(content,index)
+    if match is None:
+        raise PDFFormatError("PDF startxref entry does not contain an offset")
+    return int(match.group(1))
+
+def parse_xref_section(content,offset):
+    '''parse the cross-reference table and trailer starting at <offset>,
+    returns a dictionary mapping object numbers to (offset,gen_id,None), or
+    None for free entries, along with the text of the trailer dictionary'''
+    if content[offset:offset+4] != 'xref':
+        raise PDFFormatError("No cross-reference table found at offset " + str(offset))
+    pos = offset + 4
+    entries = {}
+    while True:
+        subsection = PDF_XREF_SUBSECTION_REGEX.match(content,pos)
+        if subsection is None:
+            break
+        first = int(subsection.group(1))
+        count = int(subsection.group(2))
+        pos = subsection.end()
+        for obj_id in xrange(first,first+count):
+            entry = PDF_XREF_ENTRY_REGEX.match(content,pos)
+            if entry is None:
+                raise PDFFormatError("Cross-reference subsection at offset " + str(offset) + " is truncated")
+            pos = entry.end()
+            if entry.group(3) == 'n':
+                entries[obj_id] = (int(entry.group(1)),int(entry.group(2)),None)
+            else:
+                entries[obj_id] = None
+    start = content.find('trailer',pos)
+    end = content.find('startxref',pos)
+    if start < 0 or end < 0 or start > end:
+        raise PDFFormatError("Cross-reference table at offset " + str(offset) + " is not followed by a trailer")
+    return entries,content[start+len('trailer'):end]
+
+def parse_xref_stream(content,offset):
+    '''parse the cross-reference stream object at <offset>.  Returns the
+    entries as parse_xref_section does, objects stored in object streams are
+    given as (index,0,stream_obj_id), along with the source of the stream
+    dictionary, which stands in for the trailer'''
+    header = PDF_OBJ_HEADER_REGEX.match(content,offset)
+    if header is None:
+        raise PDFFormatError("No cross-reference table or stream found at offset " + str(offset))
+    end = find_obj_end(content,offset)
+    obj_type,stream = parse_pdf_value(content,offset,end)
+    if obj_type != PDF_TYPE_STREAM or stream.get('/Type') != '/XRef':
+        raise PDFFormatError("Object at offset " + str(offset) + " is not a cross-reference stream")
+    try:
+        widths = stream['/W']
+        size = stream['/Size']
+        index = stream.get('/Index',[0,size])
+        data = stream.decode()
+    except Exception as e:
+        raise PDFFormatError("Cross-reference stream at offset " + str(offset) + " is damaged: " + str(e))
+    row_length = sum(widths)
+    entries = {}
+    pos = 0
+    for i in range(0,len(index)-1,2):
+        for obj_id in xrange(index[i],index[i]+index[i+1]):
+            if pos + row_length > len(data):
+                raise PDFFormatError("Cross-reference stream at offset " + str(offset) + " is truncated")
+            fields = []
+            for width in widths:
+                field = 0
+                for c in data[pos:pos+width]:
+                    field = (field << 8) | ord(c)
+                fields.append(field)
+                pos += width
+            if widths[0] == 0:
+                fields[0] = 1
+            if fields[0] == 1:
+                entries[obj_id] = (fields[1],fields[2],None)
+            elif fields[0] == 2:
+                entries[obj_id] = (fields[2],0,fields[1])
+            elif fields[0] == 0:
+                entries[obj_id] = None
+    return entries,content[header.end():get_dict_end(content,header.end(),end)]
+
+def get_dict_end(content,pos,end=None):
+    '''return the offset just past the value, usually a dictionary, that starts
+    at <pos>'''
+    parser = PDFParser(content,pos,end)
+    parser.parse_value()
+    return parser.get_position()
+
+def parse_obj_stream(data,count,first):
+    '''read the header of a decoded object stream holding <count> objects,
+    returns a list of (obj_id,start,end) bounds of each object in <data>'''
+    header = PDFParser(data,0,first).parse_values()
+    if len(header) < 2*count:
+        raise PDFFormatError("Object stream header lists fewer than " + str(count) + " objects")
+    members = []
+    for i in range(count):
+        start = first + header[2*i+1]
+        if i+1 < count:
+            end = first + header[2*i+3]
+        else:
+            end = len(data)
+        members.append((header[2*i],start,end))
+    return members
+
+# Value of PDFObjectTable.obj_types for objects that have not been classified
+PDF_TYPE_UNKNOWN = -2
+
+class PDFObjectTable(object):
+    '''index of the objects in a file, kept in parallel typed arrays indexed by
+    object number rather than as a dictionary of tuples.  Each object has an
+    offset, a generation number, the number of the object stream holding it
+    (-1 when it sits directly in the file, in which case the offset is a byte
+    offset, otherwise it is the index within the stream) and its type once
+    known'''
+    def __init__(self,size=0):
+        self.offsets = array('l')
+        self.gen_ids = array('H')
+        self.stream_ids = array('l')
+        self.obj_types = array('b')
+        self.count = 0
+        self._grow(size)
+
+    def _grow(self,size):
+        extra = size - len(self.offsets)
+        if extra <= 0:
+            return
+        self.offsets.extend(array('l',[-1])*extra)
+        self.gen_ids.extend(array('H',[0])*extra)
+        self.stream_ids.extend(array('l',[-1])*extra)
+        self.obj_types.extend(array('b',[PDF_TYPE_UNKNOWN])*extra)
+
+    def set(self,obj_id,offset,gen_id=0,stream_id=None):
+        if obj_id >= len(self.offsets):
+            self._grow(max(obj_id+1,2*len(self.offsets)))
+        if self.offsets[obj_id] < 0:
+            self.count += 1
+        self.offsets[obj_id] = offset
+        self.gen_ids[obj_id] = gen_id
+        if stream_id is None:
+            stream_id = -1
+        self.stream_ids[obj_id] = stream_id
+        self.obj_types[obj_id] = PDF_TYPE_UNKNOWN
+
+    def __contains__(self,obj_id):
+        return 0 <= obj_id < len(self.offsets) and self.offsets[obj_id] >= 0
+
+    def __getitem__(self,obj_id):
+        '''return the entry for <obj_id> as a tuple of (offset,gen_id,stream_id)'''
+        if obj_id not in self:
+            raise KeyError(obj_id)
+        stream_id = self.stream_ids[obj_id]
+        if stream_id < 0:
+            stream_id = None
+        return self.offsets[obj_id],self.gen_ids[obj_id],stream_id
+
+    def __setitem__(self,obj_id,entry):
+        self.set(obj_id,*entry)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        offsets = self.offsets
+        for obj_id in xrange(len(offsets)):
+            if offsets[obj_id] >= 0:
+                yield obj_id
 
+    def get_gen_id(self,obj_id):
+        if obj_id not in self:
+            raise KeyError(obj_id)
+        return self.gen_ids[obj_id]
+
+    def get_obj_type(self,obj_id):
+        return self.obj_types[obj_id]
+
+    def set_obj_type(self,obj_id,obj_type):
+        self.obj_types[obj_id] = obj_type
+
+    def max_obj_id(self):
+        for obj_id in xrange(len(self.offsets)-1,-1,-1):
+            if self.offsets[obj_id] >= 0:
+                return obj_id
+        return -1
+
+    def max_gen_id(self):
+        return max([0] + [self.gen_ids[i] for i in self])
+
+    def memory_size(self):
+        '''number of bytes held by the arrays of the table'''
+        return sum(a.buffer_info()[1]*a.itemsize for a in (self.offsets,self.gen_ids,self.stream_ids,self.obj_types))
+
+    def pack(self):
+        '''return the table as a tuple of builtin types for marshal, see unpack'''
+        return (self.offsets.itemsize,self.offsets.tostring(),self.gen_ids.tostring(),self.stream_ids.tostring(),self.obj_types.tostring(),self.count)
+
+    @classmethod
+    def unpack(cls,data):
+        '''rebuild a table from the tuple returned by pack'''
+        itemsize,offsets,gen_ids,stream_ids,obj_types,count = data
+        table = cls()
+        if itemsize != table.offsets.itemsize:
+            raise ValueError("Object table was packed with " + str(itemsize) + " byte offsets")
+        table.offsets.fromstring(offsets)
+        table.gen_ids.fromstring(gen_ids)
+        table.stream_ids.fromstring(stream_ids)
+        table.obj_types.fromstring(obj_types)
+        table.count = count
+        return table
+
+def get_xref_stm(trailer):
+    '''return the /XRefStm offset of a hybrid file's trailer, or None'''
+    match = PDF_XREFSTM_REGEX.search(trailer)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+def get_xref_prev(trailer):
+    '''return the /Prev offset of a trailer dictionary, or None'''
+    match = PDF_PREV_REGEX.search(trailer)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+def find_obj_end(content,offset):
+    '''return the offset just past the endobj keyword of the object at <offset>'''
+    end = content.find('endobj',offset)
+    if end < 0:
+        raise PDFFormatError("Object at offset " + str(offset) + " is not terminated by endobj")
+    return end + len('endobj')
 
 def remove_comments(pdf_text):
     return re.sub(r'%.*','',pdf_text)
@@ -419,6 +1566,13 @@ def assert_pdf_ext(filename):
     else:
         return filename + '.pdf'
 
+def get_new_file_mode():
+    '''return the mode open() gives a new file, 0666 less the umask.  Files made
+    with tempfile.mkstemp are 0600 and are set to this before being renamed'''
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
 def parse_obj_id(obj):
     matches = re.findall(r'(\d+ \d+) (R|obj)',obj)
     if len(matches) > 0:
@@ -440,6 +1594,85 @@ def get_pdf_date():
     time = re.sub(r'[^\d]','',str(time)[:str(time).find('.')])
     return 'D:'+time
 
+# Keys that only have meaning in the dictionary of a cross-reference stream and
+# must not be carried into a trailer written after it
+PDF_XREF_STREAM_KEYS = ('/Type','/W','/Index','/XRefStm','/Filter','/DecodeParms','/Length','/Prev','stream')
+
+def format_xref_section(entries):
+    '''write a cross-reference section for <entries>, a dictionary of
+    {obj_id:(offset,gen_id)}, grouping runs of consecutive object numbers into
+    subsections'''
+    buf = ["xref\n"]
+    obj_ids = sorted(entries)
+    i = 0
+    while i < len(obj_ids):
+        j = i + 1
+        while j < len(obj_ids) and obj_ids[j] == obj_ids[j-1] + 1:
+            j += 1
+        buf.append(str(obj_ids[i]) + " " + str(j-i) + "\n")
+        for obj_id in obj_ids[i:j]:
+            offset,gen_id = entries[obj_id]
+            buf.append(format_pos_number(offset) + " " + format_gen_number(gen_id) + " n \n")
+        i = j
+    return ''.join(buf)
+
+def format_xref_table(entries,size):
+    '''write a cross-reference table for object numbers 0 to <size>-1 as a single
+    subsection, <entries> is a dictionary of {obj_id:(offset,gen_id)} and the
+    numbers missing from it are linked into the free list'''
+    free = [obj_id for obj_id in xrange(1,size) if obj_id not in entries] + [0]
+    buf = ["xref\n0 " + str(size) + "\n" + format_pos_number(free[0]) + " 65535 f \n"]
+    i = 1
+    for obj_id in xrange(1,size):
+        if obj_id in entries:
+            offset,gen_id = entries[obj_id]
+            buf.append(format_pos_number(offset) + " " + format_gen_number(gen_id) + " n \n")
+        else:
+            buf.append(format_pos_number(free[i]) + " 00001 f \n")
+            i += 1
+    return ''.join(buf)
+
+# Number of objects packed into each object stream written on save
+PDF_OBJ_STREAM_SIZE = 100
+
+def format_obj_stream(members):
+    '''return the data of an object stream holding <members>, a list of
+    (obj_id,source) pairs, along with the offset of the first object'''
+    header = []
+    offset = 0
+    for obj_id,source in members:
+        header.append(str(obj_id) + " " + str(offset))
+        offset += len(source) + 1
+    header = " ".join(header) + "\n"
+    return header + "\n".join(source for obj_id,source in members) + "\n",len(header)
+
+def _pack_int(n,width):
+    return ''.join(chr((n >> (8*i)) & 0xff) for i in range(width-1,-1,-1))
+
+def format_xref_stream(entries,size):
+    '''return the data and /W widths of a cross-reference stream for object numbers
+    0 to <size>-1, <entries> is a dictionary of {obj_id:(offset,gen_id,stream_id)}
+    where offset is the index within the object stream when stream_id is set,
+    the numbers missing from it are linked into the free list'''
+    free = [obj_id for obj_id in xrange(1,size) if obj_id not in entries] + [0]
+    width = 1
+    for offset,gen_id,stream_id in entries.itervalues():
+        while max(offset,stream_id) >= 1 << (8*width):
+            width += 1
+    rows = [chr(0) + _pack_int(free[0],width) + _pack_int(65535,2)]
+    i = 1
+    for obj_id in xrange(1,size):
+        if obj_id in entries:
+            offset,gen_id,stream_id = entries[obj_id]
+            if stream_id is None:
+                rows.append(chr(1) + _pack_int(offset,width) + _pack_int(gen_id,2))
+            else:
+                rows.append(chr(2) + _pack_int(stream_id,width) + _pack_int(offset,2))
+        else:
+            rows.append(chr(0) + _pack_int(free[i],width) + _pack_int(1,2))
+            i += 1
+    return ''.join(rows),[1,width,2]
+
 def format_and_pad(n,padding_digits=10,pad_with=' '):
     return ''.join(pad_with for i in range(padding_digits-len(str(n))))+str(n) 
 